@@ -12,45 +12,87 @@
 Hook which chooses an environment file to use based on the current context.
 """
 
+import os
+
 from tank import Hook
+from tank_vendor import yaml
+
+# file holding the rules mapping contexts to environments, next to the core hooks folder
+RULES_FILE_NAME = "pick_environment.yml"
+
+# rules loaded per rules file, ie. per pipeline configuration, once per process.
+# the hook instances don't outlive a call, the module does.
+_rules = {}
+
+# environment picked per rules file and context signature
+_picked_environments = {}
+
+# number of times the hook was invoked, and how many of these were answered from
+# the picked environments
+invocation_count = 0
+memoized_count = 0
 
 
 class PickEnvironment(Hook):
     def execute(self, context, **kwargs):
         """
-        The default implementation assumes there are three environments, called shot, asset
-        and project, and switches to these based on entity type.
+        Pick the environment from the rules of the pick_environment.yml file, based
+        on the source entity type, the entity type and whether the context has a step.
+        Contexts without a project go to the site environment.
         """
-        if context.source_entity:
-            if context.source_entity["type"] == "Version":
-                return "version"
-            elif context.source_entity["type"] == "PublishedFile":
-                return "publishedfile"
-            elif context.source_entity["type"] == "Playlist":
-                return "playlist"
-
-        if context.project is None:
+        global invocation_count, memoized_count
+        invocation_count += 1
+
+        rules_path = os.path.normpath(
+            os.path.join(self.disk_location, os.pardir, RULES_FILE_NAME)
+        )
+        rules = self._get_rules(rules_path)
+
+        signature = (
+            rules_path,
+            context.source_entity["type"] if context.source_entity else None,
+            context.project is not None,
+            context.entity["type"] if context.entity else None,
+            context.step is not None,
+        )
+        if signature in _picked_environments:
+            memoized_count += 1
+        else:
+            _picked_environments[signature] = self._pick(rules, *signature[1:])
+
+        environment = _picked_environments[signature]
+        self.logger.debug(
+            "Picked environment %s (%d invocations, %d memoized)"
+            % (environment, invocation_count, memoized_count)
+        )
+        return environment
+
+    def _pick(self, rules, source_entity_type, has_project, entity_type, has_step):
+        """
+        Apply the rules to a context signature.
+        """
+        source_environment = rules.get("source_entities", {}).get(source_entity_type)
+        if source_environment:
+            return source_environment
+
+        if not has_project:
             # Our context is completely empty. We're going into the site context.
             return "site"
 
-        if context.entity is None:
+        if entity_type is None:
             # We have a project but not an entity.
-            return "project"
-
-        if context.entity and context.step is None:
-            # We have an entity but no step.
-            if context.entity["type"] == "Shot":
-                return "shot"
-            if context.entity["type"] == "Asset":
-                return "asset"
-            if context.entity["type"] == "Sequence":
-                return "sequence"
-
-        if context.entity and context.step:
-            # We have a step and an entity.
-            if context.entity["type"] == "Shot":
-                return "shot_step"
-            if context.entity["type"] == "Asset":
-                return "asset_step"
-
-        return None
+            return rules.get("project")
+
+        entity_rules = rules.get("entities", {}).get(entity_type) or {}
+        return entity_rules.get("step" if has_step else "no_step")
+
+    def _get_rules(self, path):
+        """
+        Return the rules of a rules file, loading them on first use. Changes to the
+        rules file are picked up by new processes.
+        """
+        if path not in _rules:
+            with open(path, "r") as fp:
+                _rules[path] = yaml.safe_load(fp) or {}
+
+        return _rules[path]
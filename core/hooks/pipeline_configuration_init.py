@@ -0,0 +1,460 @@
+# Copyright (c) 2024 Yeti Tools Software
+#
+# CONFIDENTIAL AND PROPRIETARY
+
+"""
+Hook which gets executed every time a new PipelineConfiguration instance is created.
+
+The parsed environment and template files are preloaded by tk-core before this hook
+runs, from the yaml_cache.pickle file written by the ``tank cache_yaml`` command when
+the configuration is deployed. Each cached file is validated by its modification time
+and size, only the files changed since are parsed again.
+
+It makes template_from_path use an index of the template definitions, so that a
+path is only validated against the few templates whose static folders match it instead
+of every template of the configuration.
+
+Finally the folders searched by paths_from_template, e.g. the work areas listed by
+the File Open dialog, are read through a persistent index of the folder contents of
+the configuration, loaded the first time a path is searched. Only the folders
+modified since they were last listed are read again.
+"""
+
+import atexit
+import fnmatch
+import functools
+import glob
+import json
+import os
+import re
+import threading
+import time
+
+import tank.api
+from tank import Hook
+from tank.errors import TankMultipleMatchingTemplatesError
+from tank.pipelineconfig_utils import get_currently_running_api_version
+from tank.template import TemplatePath
+
+# name of the folder index file, stored in the cache location of the configuration
+FOLDER_INDEX_FILE_NAME = "folder_index.json"
+
+# version of the folder index format, bump it to discard the existing indexes
+FOLDER_INDEX_VERSION = 2
+
+# maximum number of entries kept in the folder index, counting each folder and each
+# of its entry names, the least recently used folders are dropped first
+FOLDER_INDEX_MAX_ENTRIES = 100000
+
+# folders holding more entries than this, e.g. the frames of an image sequence, are
+# not indexed but listed every time
+FOLDER_INDEX_MAX_FOLDER_ENTRIES = 1000
+
+# version of tk-core whose paths_from_template was checked to glob through the glob
+# module of tank.api, keep it in sync with core/core_api.yml. the folder index is
+# not used with any other version.
+FOLDER_INDEX_CORE_VERSION = "v0.21.6"
+
+# folders modified less than this number of seconds before being listed are not
+# indexed, they could be modified again without their modification time changing
+FOLDER_INDEX_MTIME_RESOLUTION = 2
+
+# optional sections of a template definition containing a folder separator, which
+# change the number of folders of the matching paths
+MULTI_FOLDER_OPTIONAL_REGEX = re.compile(r"\[[^\]]*/[^\]]*\]")
+
+# folder indexes per index file path, shared by the pipeline configurations of the
+# same project
+_folder_indexes = {}
+_folder_indexes_lock = threading.Lock()
+
+# folder index used by the paths_from_template call running in the current thread
+_folder_index_context = threading.local()
+
+
+class PipelineConfigurationInit(Hook):
+    def execute(self, **kwargs):
+        """
+        Install the template and folder indexes.
+        """
+        _install_template_path_index()
+
+        core_version = get_currently_running_api_version()
+        if core_version != FOLDER_INDEX_CORE_VERSION:
+            self.logger.debug(
+                "Not using the folder index with tk-core %s, it requires %s."
+                % (core_version, FOLDER_INDEX_CORE_VERSION)
+            )
+            return
+
+        # the index is only read from disk once a path of this configuration is
+        # searched, most processes never call paths_from_template
+        self.parent._folder_index = _get_folder_index(
+            os.path.join(
+                os.path.dirname(self.parent.get_path_cache_location()),
+                FOLDER_INDEX_FILE_NAME,
+            ),
+            self.logger,
+        )
+        _install_folder_index()
+
+
+class TemplatePathIndex(object):
+    """
+    Index of the path templates, used to find the templates matching a path without
+    validating the path against every template.
+
+    The definitions, including their root path, are split into folders and stored in a
+    trie. Folders without any key or optional section are static and must match the
+    path exactly, the other ones match any folder. Looking up a path walks the trie
+    and returns the templates defined with the same number of folders, which are then
+    validated as usual.
+    """
+
+    def __init__(self, templates):
+        """
+        :param dict templates: The templates of a toolkit instance, per name.
+        """
+        self.templates = templates
+
+        self._root = _TemplatePathNode()
+
+        # templates which can't be indexed, always validated
+        self._unindexed = []
+
+        for template in templates.values():
+            is_path = isinstance(template, TemplatePath)
+            if not is_path or MULTI_FOLDER_OPTIONAL_REGEX.search(template.definition):
+                self._unindexed.append(template)
+                continue
+
+            node = self._root
+            folders = self._split(template.root_path) + template.definition.split("/")
+            for folder in folders:
+                if "{" in folder or "[" in folder:
+                    if node.dynamic_child is None:
+                        node.dynamic_child = _TemplatePathNode()
+                    node = node.dynamic_child
+                else:
+                    node = node.static_children.setdefault(
+                        self._normalize(folder), _TemplatePathNode()
+                    )
+            node.templates.append(template)
+
+    def template_from_path(self, path):
+        """
+        Find the template matching the given path.
+
+        :param str path: The path to match.
+
+        :returns: The matching template, or None if no template matches.
+        :raises TankMultipleMatchingTemplatesError: If several templates match.
+        """
+        nodes = [self._root]
+        for folder in self._split(path):
+            folder = self._normalize(folder)
+            next_nodes = []
+            for node in nodes:
+                if folder in node.static_children:
+                    next_nodes.append(node.static_children[folder])
+                if node.dynamic_child is not None:
+                    next_nodes.append(node.dynamic_child)
+            nodes = next_nodes
+            if not nodes:
+                break
+
+        candidates = [template for node in nodes for template in node.templates]
+        matched = [
+            template
+            for template in candidates + self._unindexed
+            if template.validate(path)
+        ]
+
+        if not matched:
+            return None
+        elif len(matched) == 1:
+            return matched[0]
+
+        # ambiguity! tell the user which templates matched
+        msg = "%d templates are matching the path '%s'.\n" % (len(matched), path)
+        msg += "The overlapping templates are:\n"
+        msg += "\n".join([str(x) for x in matched])
+        raise TankMultipleMatchingTemplatesError(msg)
+
+    @staticmethod
+    def _split(path):
+        """
+        Split a path into its folders, ignoring empty ones.
+        """
+        return [folder for folder in re.split(r"[\\/]", path) if folder]
+
+    @staticmethod
+    def _normalize(folder):
+        """
+        Normalize a folder name for comparison. The template parser of tk-core
+        matches paths case insensitively on all platforms, so does the index.
+        """
+        return folder.lower()
+
+
+class _TemplatePathNode(object):
+    """
+    Node of the TemplatePathIndex trie.
+    """
+
+    __slots__ = ("static_children", "dynamic_child", "templates")
+
+    def __init__(self):
+        # children per static folder name, child for the folders holding keys and
+        # templates whose definition ends on this node
+        self.static_children = {}
+        self.dynamic_child = None
+        self.templates = []
+
+
+def _indexed_template_from_path(tk, path):
+    """
+    Replacement of Sgtk.template_from_path using a TemplatePathIndex, rebuilt whenever
+    the templates of the toolkit instance are reloaded.
+    """
+    index = getattr(tk, "_template_path_index", None)
+    if index is None or index.templates is not tk.templates:
+        index = tk._template_path_index = TemplatePathIndex(tk.templates)
+    return index.template_from_path(path)
+
+
+_indexed_template_from_path.__doc__ = tank.api.Sgtk.template_from_path.__doc__
+
+
+def _install_template_path_index():
+    """
+    Make Sgtk.template_from_path use the template index, once per process.
+    """
+    if tank.api.Sgtk.template_from_path is not _indexed_template_from_path:
+        tank.api.Sgtk.template_from_path = _indexed_template_from_path
+
+
+class FolderIndex(object):
+    """
+    Index of the names of the entries of folders, used to glob paths without listing
+    every folder again.
+
+    The names of a folder are stored with its modification time, which changes
+    whenever an entry is added, removed or renamed. A folder is only listed again
+    when its modification time differs from the indexed one, checking it costs a
+    single stat call. The index is read from disk the first time a folder is listed
+    and saved back when the process exits.
+
+    Folders holding more than ``FOLDER_INDEX_MAX_FOLDER_ENTRIES`` entries, e.g. the
+    frames of an image sequence, are never indexed, and the least recently used
+    folders are dropped once the index holds ``FOLDER_INDEX_MAX_ENTRIES`` entries, so
+    that the index file stays small enough to be read and written whole.
+    """
+
+    def __init__(self, path, logger):
+        """
+        :param str path: Path of the index file.
+        :param logger: Logger to report index errors to.
+        """
+        self.path = path
+        self._logger = logger
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        # modification time and entry names per folder, least recently used first,
+        # None until the index is read from disk
+        self._folders = None
+
+        # number of folders and entry names held by the index
+        self._entry_count = 0
+
+    def iglob(self, pattern):
+        """
+        Drop-in replacement of glob.iglob, returning the paths matching a pattern.
+
+        :param str pattern: The pattern to match.
+
+        :returns: An iterator over the matching paths.
+        """
+        if not glob.has_magic(pattern):
+            return iter([pattern] if os.path.lexists(pattern) else [])
+
+        drive, path = os.path.splitdrive(pattern)
+        parts = re.split(r"[\\/]", path)
+        first_magic = next(i for i, part in enumerate(parts) if glob.has_magic(part))
+        base = drive + os.sep.join(parts[:first_magic])
+        if not os.path.isabs(base):
+            # only absolute patterns are indexed
+            return glob.iglob(pattern)
+        if not os.path.isdir(base):
+            return iter([])
+
+        paths = [base]
+        for part in parts[first_magic:]:
+            if not part:
+                continue
+            matches = []
+            for path in paths:
+                names = self.list_folder(path)
+                if glob.has_magic(part):
+                    if not part.startswith("."):
+                        # hidden files are not matched by wildcards, like glob does
+                        names = [name for name in names if not name.startswith(".")]
+                    names = fnmatch.filter(names, part)
+                else:
+                    part_key = os.path.normcase(part)
+                    names = [
+                        name for name in names if os.path.normcase(name) == part_key
+                    ]
+                matches.extend(os.path.join(path, name) for name in names)
+            paths = matches
+
+        return iter(paths)
+
+    def list_folder(self, folder):
+        """
+        Return the names of the entries of a folder, from the index if the folder
+        didn't change since it was indexed.
+
+        :param str folder: The folder to list.
+
+        :returns: The list of names, empty if the path is not a readable folder.
+        """
+        try:
+            mtime = os.stat(folder).st_mtime_ns
+            with self._lock:
+                if self._folders is None:
+                    self._folders = self._load()
+                    self._entry_count = sum(
+                        len(names) + 1 for _, names in self._folders.values()
+                    )
+                entry = self._folders.get(folder)
+                if entry is not None and entry[0] == mtime:
+                    # move the folder to the most recently used end
+                    self._folders[folder] = self._folders.pop(folder)
+                    return entry[1]
+            names = os.listdir(folder)
+        except OSError:
+            return []
+
+        with self._lock:
+            entry = self._folders.pop(folder, None)
+            if entry is not None:
+                self._entry_count -= len(entry[1]) + 1
+                self._dirty = True
+
+            if (
+                len(names) <= FOLDER_INDEX_MAX_FOLDER_ENTRIES
+                and time.time_ns() - mtime > FOLDER_INDEX_MTIME_RESOLUTION * 10**9
+            ):
+                self._folders[folder] = (mtime, names)
+                self._entry_count += len(names) + 1
+                while self._entry_count > FOLDER_INDEX_MAX_ENTRIES:
+                    _, dropped_names = self._folders.pop(next(iter(self._folders)))
+                    self._entry_count -= len(dropped_names) + 1
+                self._dirty = True
+        return names
+
+    def save(self):
+        """
+        Write the index to disk if it changed, through a temporary file so that other
+        processes never read a partially written index.
+        """
+        with self._lock:
+            if not self._dirty:
+                return
+            data = {
+                "version": FOLDER_INDEX_VERSION,
+                "folders": [
+                    [folder, mtime, names]
+                    for folder, (mtime, names) in self._folders.items()
+                ],
+            }
+            self._dirty = False
+
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        try:
+            with open(tmp_path, "w") as fp:
+                json.dump(data, fp)
+            os.replace(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            self._logger.debug("Unable to write folder index %s: %s" % (self.path, e))
+
+    def _load(self):
+        """
+        Read the index from disk.
+
+        :returns: The indexed folders, empty if the index does not exist or is
+            invalid.
+        """
+        try:
+            with open(self.path, "r") as fp:
+                data = json.load(fp)
+            if data.get("version") != FOLDER_INDEX_VERSION:
+                return {}
+            return {folder: (mtime, names) for folder, mtime, names in data["folders"]}
+        except (IOError, OSError, ValueError, TypeError, KeyError, AttributeError) as e:
+            if os.path.exists(self.path):
+                self._logger.debug(
+                    "Ignoring invalid folder index %s: %s" % (self.path, e)
+                )
+            return {}
+
+
+class _FolderIndexGlob(object):
+    """
+    Stand-in for the glob module used by tank.api, globbing through the FolderIndex
+    of the paths_from_template call running in the current thread, if any.
+    """
+
+    def iglob(self, pattern):
+        folder_index = getattr(_folder_index_context, "folder_index", None)
+        if folder_index is None:
+            return glob.iglob(pattern)
+        return folder_index.iglob(pattern)
+
+    def glob(self, pattern):
+        return list(self.iglob(pattern))
+
+    def __getattr__(self, name):
+        return getattr(glob, name)
+
+
+def _get_folder_index(path, logger):
+    """
+    Return the folder index stored in the given file, without reading it.
+
+    :param str path: Path of the index file.
+    :param logger: Logger to report index errors to.
+    """
+    with _folder_indexes_lock:
+        folder_index = _folder_indexes.get(path)
+        if folder_index is None:
+            folder_index = _folder_indexes[path] = FolderIndex(path, logger)
+            atexit.register(folder_index.save)
+    return folder_index
+
+
+def _install_folder_index():
+    """
+    Make Sgtk.paths_from_template glob through the folder index of the pipeline
+    configuration of the toolkit instance, once per process.
+    """
+    paths_from_template = tank.api.Sgtk.paths_from_template
+    if getattr(paths_from_template, "uses_folder_index", False):
+        return
+
+    @functools.wraps(paths_from_template)
+    def indexed_paths_from_template(tk, *args, **kwargs):
+        previous = getattr(_folder_index_context, "folder_index", None)
+        _folder_index_context.folder_index = getattr(
+            tk.pipeline_configuration, "_folder_index", None
+        )
+        try:
+            return paths_from_template(tk, *args, **kwargs)
+        finally:
+            _folder_index_context.folder_index = previous
+
+    indexed_paths_from_template.uses_folder_index = True
+    tank.api.Sgtk.paths_from_template = indexed_paths_from_template
+    tank.api.glob = _FolderIndexGlob()
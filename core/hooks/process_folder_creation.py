@@ -0,0 +1,185 @@
+# Copyright (c) 2024 Yeti Tools Software
+#
+# CONFIDENTIAL AND PROPRIETARY
+
+"""
+Hook called to create the files and folders planned by the folder creation.
+
+The folder creation hands over the complete list of items computed from the schema
+in one call. Instead of checking and creating every path on its own, the items are
+processed in path order and the folders known to exist are remembered, so that the
+shared parents of a large hierarchy, e.g. the sequence folder of hundreds of shots,
+are only checked once and each missing folder costs a single mkdir call.
+"""
+
+import os
+import shutil
+import time
+
+from tank import Hook
+from tank.util import is_windows
+
+
+class ProcessFolderCreation(Hook):
+    def execute(self, items, preview_mode, **kwargs):
+        """
+        Create the given files and folders.
+
+        Each item is a dictionary with an action key, one of entity_folder, folder,
+        remote_entity_folder, symlink, copy or create_file, and the keys required by
+        that action.
+
+        :param list items: The items to process.
+        :param bool preview_mode: Only report the paths which would be created.
+
+        :returns: The paths which were created, or would be in preview mode.
+        """
+        start_time = time.time()
+        folders = _FolderCreator(preview_mode)
+        locations = []
+
+        # set the umask so that we get true permissions
+        old_umask = os.umask(0)
+        try:
+            # process the parents before their children, so that the folders created
+            # for an item are known to exist for the next ones
+            for item in sorted(items, key=_get_item_sort_key):
+                action = item.get("action")
+                if action in ["entity_folder", "folder"]:
+                    # folder creation
+                    path = item.get("path")
+                    if folders.ensure(path):
+                        locations.append(path)
+
+                elif action == "remote_entity_folder":
+                    # folder created by another user, already on the shared storage
+                    pass
+
+                elif action == "symlink":
+                    # symbolic link
+                    if is_windows():
+                        continue
+                    path = item.get("path")
+                    if not os.path.lexists(path):
+                        if not preview_mode:
+                            os.symlink(item.get("target"), path)
+                        locations.append(path)
+
+                elif action == "copy":
+                    # a file copy
+                    source_path = item.get("source_path")
+                    target_path = item.get("target_path")
+                    if not os.path.exists(target_path):
+                        if not preview_mode:
+                            folders.ensure(os.path.dirname(target_path))
+                            # do a standard file copy and set permissions to open
+                            shutil.copy(source_path, target_path)
+                            os.chmod(target_path, 0o666)
+                        locations.append(target_path)
+
+                elif action == "create_file":
+                    # create a new file based on content
+                    path = item.get("path")
+                    folders.ensure(os.path.dirname(path))
+                    if not os.path.exists(path):
+                        if not preview_mode:
+                            # create the file and set permissions to open
+                            with open(path, "wb") as fp:
+                                fp.write(item.get("content"))
+                            os.chmod(path, 0o666)
+                        locations.append(path)
+
+                else:
+                    raise Exception("Unknown folder hook action '%s'" % action)
+
+        except Exception:
+            # print the full call stack for debugging
+            self.logger.exception("Could not create folder")
+            raise
+        finally:
+            os.umask(old_umask)
+
+        self.logger.debug(
+            "Processed %d folder creation items in %.3fs: %d folders created, %d "
+            "existence checks, %d already known to exist."
+            % (
+                len(items),
+                time.time() - start_time,
+                folders.created_count,
+                folders.checked_count,
+                folders.known_count,
+            )
+        )
+        return locations
+
+
+class _FolderCreator(object):
+    """
+    Create folders with their missing parents, remembering the folders known to exist
+    so that they are neither checked nor created again.
+    """
+
+    def __init__(self, preview_mode):
+        """
+        :param bool preview_mode: Only record the folders which would be created.
+        """
+        self._preview_mode = preview_mode
+        self._existing = set()
+
+        # statistics reported once all the items are processed
+        self.created_count = 0
+        self.checked_count = 0
+        self.known_count = 0
+
+    def ensure(self, path):
+        """
+        Make sure a folder and all its parents exist.
+
+        :param str path: The folder path.
+
+        :returns: True if the folder was created, False if it already existed.
+        """
+        path = os.path.normpath(path)
+        if path in self._existing:
+            self.known_count += 1
+            return False
+
+        # walk up to the closest folder which exists, collecting the missing ones
+        missing = []
+        current = path
+        while current not in self._existing:
+            self.checked_count += 1
+            if os.path.isdir(current):
+                break
+            missing.append(current)
+            parent = os.path.dirname(current)
+            if parent == current:
+                break
+            current = parent
+
+        self._existing.add(current)
+        created = False
+        for folder in reversed(missing):
+            if not self._preview_mode:
+                try:
+                    # create the folder using open permissions
+                    os.mkdir(folder, 0o777)
+                except FileExistsError:
+                    if not os.path.isdir(folder):
+                        raise
+                    # created by another process since it was checked
+                    self._existing.add(folder)
+                    continue
+            self.created_count += 1
+            self._existing.add(folder)
+            created = True
+
+        return created
+
+
+def _get_item_sort_key(item):
+    """
+    Return the key sorting the folder creation items parents first.
+    """
+    path = item.get("path") or item.get("target_path") or ""
+    return (path.count(os.sep), path)
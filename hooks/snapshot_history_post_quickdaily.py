@@ -23,7 +23,15 @@ class SnapshotHistoryPostQuickdaily(Hook):
             comment += "User Comments: %s " % comments
             comment += "Version id: %d " % version_id
             comment += "Quicktime: %s" % mov_path
-            snapshot_app.snapshot(comment)
+            # --- Yeti - begin customization
+            # thin out the older snapshots in the background, the copy_file
+            # hook of the snapshot app checks this flag
+            snapshot_app.background_thinning = True
+            try:
+                snapshot_app.snapshot(comment)
+            finally:
+                snapshot_app.background_thinning = False
+            # --- end customization
         except TankError:
             # fine, means file wasn't a proper snapshot
             pass
@@ -12,6 +12,17 @@ import sgtk
 
 HookBaseClass = sgtk.get_hook_baseclass()
 
+# --- Yeti - begin customization
+# engine instance to use for the software versions of a product, instead of the
+# engine instance found by the scan software routine
+ENGINE_INSTANCE_REDIRECTS = {
+    # we're going to end up getting a SoftwareVersion for Nuke Studio that wants
+    # to route us to the tk-nuke engine instance. We don't want that, so we'll
+    # redirect to tk-nukestudio.
+    "NukeStudio": "tk-nukestudio",
+}
+# --- end customization
+
 
 class BeforeRegisterCommand(HookBaseClass):
     """
@@ -37,10 +48,8 @@ class BeforeRegisterCommand(HookBaseClass):
         :returns: The desired engine instance name.
         :rtype: str
         """
-        # We're going to end up getting a SoftwareVersion for Nuke Studio that
-        # wants to route us to the tk-nuke engine instance. We don't want that, so
-        # we'll redirect to tk-nukestudio.
-        if software_version.product == "NukeStudio":
-            engine_instance_name = "tk-nukestudio"
-
-        return engine_instance_name
+        # --- Yeti - begin customization
+        return ENGINE_INSTANCE_REDIRECTS.get(
+            software_version.product, engine_instance_name
+        )
+        # --- end customization
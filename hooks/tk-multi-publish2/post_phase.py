@@ -6,15 +6,52 @@
 # Source Code License included in this distribution package. See LICENSE.
 
 import copy
+import hashlib
+import json
 import os
+import re
+import shutil
+import socket
+import sys
 import tempfile
+import threading
+import time
 import uuid
+from concurrent import futures
 
 import sgtk
-from tank_vendor import yaml
+from sgtk.platform.qt import QtCore
 
 HookBaseClass = sgtk.get_hook_baseclass()
 
+# maximum number of thumbnails written to disk at the same time
+THUMBNAIL_WRITE_WORKERS = 4
+
+# characters escaped in the monitor file, which only holds printable ascii
+MONITOR_ESCAPED_CHARS_REGEX = re.compile(r"[^\t\n\r\x20-\x7e]")
+
+# age in days after which the folders of finished background publishes are
+# deleted, and total size in MB the folders of the background publishes can use
+# before the least recently used ones are deleted
+BG_PUBLISH_FOLDER_MAX_AGE = float(
+    os.environ.get("YETI_BG_PUBLISH_FOLDER_MAX_AGE_DAYS", 7)
+)
+BG_PUBLISH_FOLDERS_MAX_SIZE = float(
+    os.environ.get("YETI_BG_PUBLISH_FOLDERS_MAX_SIZE_MB", 2048)
+)
+
+# time in hours without any activity after which a background publish whose
+# process never started is considered abandoned, and its folder can be deleted
+BG_PUBLISH_RUNNING_TIMEOUT = 24
+
+# file marking the folder of a background publish that has finished, and file
+# holding the host and pid of the background publishing process
+BG_PUBLISH_FINISHED_MARKER = "finished"
+BG_PUBLISH_RUNNING_MARKER = "running"
+
+# minimum time in minutes between two garbage collections of the folders
+BG_PUBLISH_CLEAN_INTERVAL = 60
+
 
 class PostPhase(HookBaseClass):
     """
@@ -24,6 +61,16 @@ class PostPhase(HookBaseClass):
     See the PublishTree documentation for additional details on how to traverse the tree and manipulate it.
     """
 
+    def post_validate(self, publish_tree):
+        """
+        This method is executed after the validation pass has completed for each
+        item in the tree, before the publish pass.
+
+        :param publish_tree: The :ref:`publish-api-tree` instance representing
+            the items to be published.
+        """
+        self._mark_bg_publish_running(publish_tree)
+
     def post_publish(self, publish_tree):
         """
         This method is executed after the publish pass has completed for each
@@ -65,21 +112,32 @@ class PostPhase(HookBaseClass):
 
         # we only want to run the actions if we're going to publish in background but we're not already in the
         # background publishing process
+        if in_bg_process:
+            self._mark_bg_publish_running(publish_tree)
+
         if not bg_processing or in_bg_process:
             return
 
+        # get the path to the folder where all the files used by the background publishing process will be stored
+        root_folder_path = os.path.join(
+            bg_publish_app.cache_location, current_engine.name
+        )
+        if not os.path.exists(root_folder_path):
+            os.makedirs(root_folder_path)
+        BackgroundPublishFolders(root_folder_path).clean_in_background()
+        tmp_folder_path = tempfile.mkdtemp(dir=root_folder_path)
+
+        # make sure the thumbnails are on disk so that we can access them later in the bg process
+        self._write_thumbnails(publish_tree, tmp_folder_path)
+
         # modify the publish tree in order to add a new property/setting on the fly in order to give
         # the item/task a unique identifier
         # this will be very useful to track the tasks progress on the monitor side
         # we can't rely on names here as some items/tasks can have the same name
         # at the same time, start to build the monitor tree
+        setting_prototypes = {}
         for item in publish_tree:
 
-            # if the item has a thumbnail, download it and make sure we can access it later in the bg process
-            thumbnail_path = item.get_thumbnail_as_path()
-            if thumbnail_path:
-                item._thumbnail_path = thumbnail_path
-
             item_uuid = str(uuid.uuid4())
             item_data = {
                 "name": item.name,
@@ -92,24 +150,19 @@ class PostPhase(HookBaseClass):
             for task in item.tasks:
                 if task.active:
 
-                    # as we can't create a PublishSetting object using the Publish API, convert the task to a dict then
-                    # add the new setting to finally reset the task from the dict
-                    uuid_setting = {
-                        "name": "Task UUID",
-                        "type": "str",
-                        "default_value": None,
-                        "description": "UUID of the current task",
-                        "value": str(uuid.uuid4()),
-                    }
-                    dummy_task_dict = task.to_dict()
-                    dummy_task_dict["settings"]["Task UUID"] = uuid_setting
-                    dummy_task = task.from_dict(dummy_task_dict, None)
-                    task.settings["Task UUID"] = dummy_task.settings["Task UUID"]
+                    task_uuid = str(uuid.uuid4())
+                    self._set_task_setting(
+                        task,
+                        "Task UUID",
+                        task_uuid,
+                        "UUID of the current task",
+                        setting_prototypes,
+                    )
 
                     item_data["tasks"].append(
                         {
                             "name": task.name,
-                            "uuid": uuid_setting["value"],
+                            "uuid": task_uuid,
                             "status": bg_publish_app.constants.WAITING_TO_START,
                         }
                     )
@@ -118,22 +171,16 @@ class PostPhase(HookBaseClass):
                 item.properties.uuid = item_uuid
                 monitor_data["items"].append(item_data)
 
-        # get the path to the folder where all the files used by the background publishing process will be stored
-        root_folder_path = os.path.join(
-            bg_publish_app.cache_location, current_engine.name
-        )
-        if not os.path.exists(root_folder_path):
-            os.makedirs(root_folder_path)
-        tmp_folder_path = tempfile.mkdtemp(dir=root_folder_path)
-
         # build the path to these files
         self.__TREE_FILE_PATH = os.path.join(tmp_folder_path, "publish_tree.yml")
         monitor_file_path = os.path.join(tmp_folder_path, "monitor.yml")
 
+        # let the background process know which folder to mark as finished
+        publish_tree.root_item.properties["bg_publish_folder"] = tmp_folder_path
+
         # finally, save the publish tree and the monitor data to the files
         publish_tree.save_file(self.__TREE_FILE_PATH)
-        with open(monitor_file_path, "w+") as fp:
-            yaml.safe_dump(monitor_data, fp)
+        _save_monitor_file(monitor_data, monitor_file_path)
 
         self.logger.info(
             "Background Publish files have been saved on disk.",
@@ -142,6 +189,95 @@ class PostPhase(HookBaseClass):
 
         # ------------------------------------------------------------------------
 
+    def _mark_bg_publish_running(self, publish_tree):
+        """
+        In the background publishing process, record its pid in its folder so
+        that the folder is not deleted while the process runs.
+
+        :param publish_tree: The :ref:`publish-api-tree` instance representing
+            the items being published.
+        """
+        if not publish_tree.root_item.properties.get("in_bg_process"):
+            return
+
+        bg_publish_folder = publish_tree.root_item.properties.get("bg_publish_folder")
+        if bg_publish_folder:
+            BackgroundPublishFolders.mark_running(bg_publish_folder)
+
+    def _set_task_setting(self, task, name, value, description, prototypes):
+        """
+        Add a string setting to a task, or replace its value.
+
+        As we can't create a PublishSetting object using the Publish API, the
+        first setting of a given name is built by converting a task to a dict,
+        adding the new setting and resetting a task from the dict. This is
+        only done once: the other tasks get a shallow copy of that setting,
+        which avoids copying all their settings back and forth.
+
+        :param task: The task to add the setting to.
+        :param str name: The name of the setting.
+        :param str value: The value of the setting.
+        :param str description: The description of the setting.
+        :param dict prototypes: Settings already built, per name. Settings
+            built by this call are added to it.
+        """
+        prototype = prototypes.get(name)
+        if prototype is None:
+            setting_dict = {
+                "name": name,
+                "type": "str",
+                "default_value": None,
+                "description": description,
+                "value": value,
+            }
+            dummy_task_dict = task.to_dict()
+            dummy_task_dict["settings"][name] = setting_dict
+            dummy_task = task.from_dict(dummy_task_dict, None)
+            prototype = prototypes[name] = dummy_task.settings[name]
+
+        setting = copy.copy(prototype)
+        setting.value = value
+        task.settings[name] = setting
+
+    def _write_thumbnails(self, publish_tree, folder_path):
+        """
+        Write the thumbnails of the items which only exist in memory to the
+        given folder, and point the items to the written files.
+
+        The pixmaps are converted to images on the main thread, as required by
+        Qt, then encoded and written by a pool of threads. The files are named
+        after a hash of their content so that identical thumbnails are only
+        written once.
+
+        :param publish_tree: The :ref:`publish-api-tree` instance representing
+            the items to be published.
+        :param str folder_path: The folder to write the thumbnails to.
+        """
+        # items sharing the same pixmap only need it to be written once
+        items_by_pixmap = {}
+        images = {}
+        for item in publish_tree:
+            if item._thumbnail_path:
+                continue
+            pixmap = item.thumbnail
+            if pixmap is None or pixmap.isNull():
+                continue
+            items_by_pixmap.setdefault(pixmap.cacheKey(), []).append(item)
+            images.setdefault(pixmap.cacheKey(), pixmap.toImage())
+
+        if not images:
+            return
+
+        with futures.ThreadPoolExecutor(
+            max_workers=THUMBNAIL_WRITE_WORKERS
+        ) as executor:
+            paths = executor.map(
+                lambda image: _write_thumbnail(image, folder_path), images.values()
+            )
+            for cache_key, path in zip(images, paths):
+                for item in items_by_pixmap[cache_key]:
+                    item._thumbnail_path = path
+
     def post_finalize(self, publish_tree):
         """
         This method is executed after the finalize pass has completed for each
@@ -170,6 +306,14 @@ class PostPhase(HookBaseClass):
         bg_processing = publish_tree.root_item.properties.get("bg_processing")
         in_bg_process = publish_tree.root_item.properties.get("in_bg_process")
 
+        if in_bg_process:
+            # the files of this background publish are not needed anymore
+            bg_publish_folder = publish_tree.root_item.properties.get(
+                "bg_publish_folder"
+            )
+            if bg_publish_folder:
+                BackgroundPublishFolders.mark_finished(bg_publish_folder)
+
         # we only want to run the actions if we're going to publish in background mode but we're not already in the
         # background publishing process
         if bg_processing and not in_bg_process:
@@ -178,3 +322,258 @@ class PostPhase(HookBaseClass):
             # launch the background publishing process and show the monitor app
             bg_publish_app.launch_publish_process(self.__TREE_FILE_PATH)
             bg_publish_app.create_panel()
+
+
+class BackgroundPublishFolders(object):
+    """
+    Garbage collection of the folders created for each background publish.
+
+    The folders of finished background publishes are deleted once they are
+    older than ``BG_PUBLISH_FOLDER_MAX_AGE``. The least recently used ones are
+    then deleted until all the folders fit in ``BG_PUBLISH_FOLDERS_MAX_SIZE``.
+
+    A folder whose background publish has not finished is never deleted while
+    its process runs, which is checked with the pid the process records in the
+    folder. A folder whose process never started is deleted once nothing was
+    written to it for ``BG_PUBLISH_RUNNING_TIMEOUT``.
+    """
+
+    def __init__(self, root_folder):
+        """
+        :param str root_folder: The folder holding the background publish folders.
+        """
+        self._root_folder = root_folder
+
+    @staticmethod
+    def mark_finished(folder):
+        """
+        Mark the folder of a background publish as finished.
+
+        :param str folder: The background publish folder.
+        """
+        try:
+            open(os.path.join(folder, BG_PUBLISH_FINISHED_MARKER), "w").close()
+        except (IOError, OSError):
+            pass
+
+    @staticmethod
+    def mark_running(folder):
+        """
+        Record the host and pid of the current process in the folder of the
+        background publish it runs.
+
+        :param str folder: The background publish folder.
+        """
+        try:
+            with open(os.path.join(folder, BG_PUBLISH_RUNNING_MARKER), "w") as fp:
+                json.dump({"host": socket.gethostname(), "pid": os.getpid()}, fp)
+        except (IOError, OSError):
+            pass
+
+    def clean_in_background(self):
+        """
+        Run :meth:`clean` on a background thread, unless the folders were
+        cleaned less than ``BG_PUBLISH_CLEAN_INTERVAL`` minutes ago.
+        """
+        stamp_path = os.path.join(self._root_folder, ".last_clean")
+        try:
+            if (
+                time.time() - os.path.getmtime(stamp_path)
+                < BG_PUBLISH_CLEAN_INTERVAL * 60
+            ):
+                return
+        except OSError:
+            pass
+
+        try:
+            open(stamp_path, "w").close()
+        except (IOError, OSError):
+            return
+
+        threading.Thread(
+            target=self.clean, name="BackgroundPublishFolders", daemon=True
+        ).start()
+
+    def clean(self):
+        """
+        Delete the folders which are too old, then the least recently used
+        ones if the folders use too much space.
+        """
+        now = time.time()
+        max_age = BG_PUBLISH_FOLDER_MAX_AGE * 24 * 60 * 60
+        running_timeout = BG_PUBLISH_RUNNING_TIMEOUT * 60 * 60
+
+        try:
+            with os.scandir(self._root_folder) as entries:
+                folder_paths = [
+                    entry.path
+                    for entry in entries
+                    if entry.is_dir(follow_symlinks=False)
+                ]
+        except OSError:
+            return
+
+        folders = []
+        for path in folder_paths:
+            # the folder may be deleted by the cleanup of another process
+            try:
+                size, last_used = self._get_usage(path)
+                if os.path.exists(os.path.join(path, BG_PUBLISH_FINISHED_MARKER)):
+                    deletable = True
+                else:
+                    deletable = self._is_abandoned(
+                        path, now - last_used > running_timeout
+                    )
+            except OSError:
+                continue
+            folders.append((last_used, size, path, deletable))
+
+        total_size = sum(size for _, size, _, _ in folders)
+        max_size = BG_PUBLISH_FOLDERS_MAX_SIZE * 1024 * 1024
+
+        # least recently used first
+        for last_used, size, path, deletable in sorted(folders):
+            if not deletable:
+                continue
+            if now - last_used <= max_age and total_size <= max_size:
+                # the other folders were used more recently
+                break
+            shutil.rmtree(path, ignore_errors=True)
+            total_size -= size
+
+    def _is_abandoned(self, folder, timed_out):
+        """
+        Return whether the background publish of an unfinished folder is not
+        running anymore.
+
+        :param str folder: The background publish folder.
+        :param bool timed_out: Whether nothing was written to the folder for
+            ``BG_PUBLISH_RUNNING_TIMEOUT``.
+        """
+        try:
+            with open(os.path.join(folder, BG_PUBLISH_RUNNING_MARKER), "r") as fp:
+                running = json.load(fp)
+        except (IOError, OSError, ValueError):
+            # the background process never started
+            return timed_out
+
+        if not isinstance(running, dict) or not running.get("pid"):
+            return timed_out
+        if running.get("host") != socket.gethostname():
+            # the process can't be checked from this machine
+            return False
+        return not _is_process_running(running["pid"])
+
+    def _get_usage(self, folder):
+        """
+        Return the size of the files of a folder and the last time one of them
+        was modified.
+
+        :param str folder: The folder to inspect.
+
+        :returns: A tuple with the size in bytes and the modification time.
+        """
+        size = 0
+        last_used = os.stat(folder).st_mtime
+        folders = [folder]
+        while folders:
+            with os.scandir(folders.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    else:
+                        stat = entry.stat(follow_symlinks=False)
+                        size += stat.st_size
+                        last_used = max(last_used, stat.st_mtime)
+        return size, last_used
+
+
+def _is_process_running(pid):
+    """
+    Return whether a process of this machine is running.
+
+    :param int pid: The id of the process.
+    """
+    if sys.platform == "win32":
+        import ctypes
+
+        PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+        STILL_ACTIVE = 259
+        ERROR_ACCESS_DENIED = 5
+
+        kernel32 = ctypes.windll.kernel32
+        handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION, False, pid)
+        if not handle:
+            return kernel32.GetLastError() == ERROR_ACCESS_DENIED
+        try:
+            exit_code = ctypes.c_ulong()
+            kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code))
+            return exit_code.value == STILL_ACTIVE
+        finally:
+            kernel32.CloseHandle(handle)
+
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _write_thumbnail(image, folder_path):
+    """
+    Write an image to the given folder as a png file named after a hash of its
+    content, unless the same content was already written.
+
+    This only uses thread-safe Qt classes and can run outside the main thread.
+
+    :param image: The QImage to write.
+    :param str folder_path: The folder to write the image to.
+
+    :returns: The path of the written file.
+    """
+    byte_array = QtCore.QByteArray()
+    buffer = QtCore.QBuffer(byte_array)
+    buffer.open(QtCore.QIODevice.WriteOnly)
+    image.save(buffer, "PNG")
+    buffer.close()
+    data = byte_array.data()
+
+    path = os.path.join(folder_path, "thumb_%s.png" % hashlib.sha1(data).hexdigest())
+    if not os.path.exists(path):
+        # write to a temporary file first, two threads may write the same content
+        tmp_path = "%s.%d.tmp" % (path, threading.get_ident())
+        with open(tmp_path, "wb") as fp:
+            fp.write(data)
+        os.replace(tmp_path, path)
+
+    return path
+
+
+def _save_monitor_file(monitor_data, file_path):
+    """
+    Write the monitor data as a yaml flow mapping, encoded by the json module which
+    is much faster than the pure python yaml dumper. The monitor still reads it
+    with its yaml parser.
+
+    The json module escapes the characters outside of the basic plane as utf-16
+    surrogate pairs, which the yaml parser rejects, so all the non ascii
+    characters are escaped as yaml escape sequences instead.
+
+    :param dict monitor_data: The items and tasks shown by the monitor.
+    :param str file_path: The file to write.
+    """
+    data = MONITOR_ESCAPED_CHARS_REGEX.sub(
+        _escape_yaml_char, json.dumps(monitor_data, ensure_ascii=False)
+    )
+    with open(file_path, "w+") as fp:
+        fp.write(data)
+
+
+def _escape_yaml_char(match):
+    """
+    Return the yaml escape sequence of the character matched by a regex.
+    """
+    code = ord(match.group())
+    return "\\u%04x" % code if code <= 0xFFFF else "\\U%08x" % code
@@ -2,8 +2,13 @@
 #
 # CONFIDENTIAL AND PROPRIETARY
 
+import array
+import collections
+import datetime
+import json
 import mimetypes
 import os
+import re
 import sgtk
 from tank import TankError
 from tank_vendor import six
@@ -12,11 +17,53 @@ logger = sgtk.platform.get_logger(__name__)
 
 HookBaseClass = sgtk.get_hook_baseclass()
 
-ACCEPTABLE_TYPES = [
+ACCEPTABLE_TYPES = frozenset([
     "anim", "blocking", "comp", "concept", "cutref", "diwip", "dmp", "edit", "fx",
     "layout", "light", "lookdev", "model", "optical", "plate", "postvis", "previs",
     "reference", "scan", "techvis", "test", "wedge",
-]
+])
+
+# naming convention of the collected files, eg.
+# single file:  LAX_0020_comp_v002.mov
+# sequence:     LAX_0020_comp_v002.%04d.exr
+# subtask:      LAX_0020_comp_pipe_v002.mov
+# extra dots:   LAX_0020_comp_v002.final.mov, LAX_0020_comp_v002.tar.gz
+# no extension: LAX_0020_comp_v002
+# a subtask is only recognized when it is followed by more name parts, so that
+# LAX_0020_comp_v002.mov has no subtask. the extension is the last dot segment.
+FILE_NAME_REGEX = re.compile(
+    r"^(?P<scene>[^_.]+)_(?P<shot>[^_.]+)_(?P<task>[^_.]+)"
+    r"(?:_(?P<subtask>[^_.]+)(?=_))?"
+    r"(?:_[^_.]+)*?"
+    r"(?:_(?P<version>v\d+))?"
+    r"(?:\.(?P<frame_spec>%0?\d*d|#+|@+|\d+)(?=\.))?"
+    r"(?:\.[^.]*)*?"
+    r"(?:\.(?P<ext>[^.]*))?$"
+)
+
+# maximum number of names sent in a single "in" filter when resolving tasks and shots
+NAME_QUERY_CHUNK_SIZE = 500
+
+# fields holding the name of the entities the collector links items to
+ENTITY_NAME_FIELDS = {"Task": "content", "Shot": "code"}
+
+# age in seconds after which the name index is refreshed with a delta query
+NAME_INDEX_TTL = 10 * 60
+
+# age in seconds after which the name index is rebuilt from scratch, which drops
+# the entities that were retired or moved to another project in the meantime
+NAME_INDEX_REBUILD_AGE = 24 * 60 * 60
+
+# overlap applied to the delta queries to make up for clock differences between
+# this machine and the server
+NAME_INDEX_SYNC_MARGIN = datetime.timedelta(minutes=1)
+
+# maximum number of contexts kept around while collecting a publish session
+CONTEXT_CACHE_SIZE = 256
+
+# frame files found when collecting a folder, eg. LAX_0020_plate_v001.1001.exr, with
+# the same frame separators as the publisher get_frame_sequences utility
+FRAME_FILE_REGEX = re.compile(r"^(?P<prefix>.*[._-])(?P<frame>\d+)(?P<ext>\.[^.]+)$")
 
 
 class BasicSceneCollector(HookBaseClass):
@@ -24,6 +71,44 @@ class BasicSceneCollector(HookBaseClass):
     Extend the default collector to potentially prelink a task to an asset.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(BasicSceneCollector, self).__init__(*args, **kwargs)
+
+        # --- Yeti - begin customization
+        # task and shot name indexes, per project id
+        self._name_indexes = {}
+        # contexts of the entities items were linked to during this session
+        self._context_cache = ContextCache(CONTEXT_CACHE_SIZE)
+        # names not found on the server during this session, per project id and
+        # entity type, and the folders whose file names were already resolved
+        self._missing_names = collections.defaultdict(set)
+        self._prefetched_folders = set()
+        # --- end customization
+
+    def process_current_session(self, settings, parent_item):
+        """
+        Analyzes the current scene open in a DCC and parses it for
+        publishable items.
+
+        :param dict settings: Configured settings for this collector
+        :param parent_item: Root item instance
+        """
+        # --- Yeti - begin customization
+        # the session is being reset, don't keep the contexts of the previous one
+        if self._context_cache.hits or self._context_cache.misses:
+            logger.debug(
+                f"Context cache: {self._context_cache.hits} hits, "
+                f"{self._context_cache.misses} misses"
+            )
+        self._context_cache.clear()
+        self._missing_names.clear()
+        self._prefetched_folders.clear()
+        # --- end customization
+
+        return super(BasicSceneCollector, self).process_current_session(
+            settings, parent_item
+        )
+
     def process_file(self, settings, parent_item, path):
         """
         Analyzes the given file and creates one or more items
@@ -47,61 +132,743 @@ class BasicSceneCollector(HookBaseClass):
             file_items = self._collect_folder(parent_item, path)
             for file_item in file_items:
                 file_item.properties["publish_templates"] = publish_templates
-                # --- Yeti - begin customization
-                self._link_item_to_task(file_item)
-                # --- end customization
+            # --- Yeti - begin customization
+            self._link_items_to_tasks(file_items)
+            # --- end customization
             return None
         else:
             file_item = self._collect_file(parent_item, path)
             file_item.properties["publish_templates"] = publish_templates
             # --- Yeti - begin customization
-            self._link_item_to_task(file_item)
+            # publish2 hands over the dropped files one at a time. resolve the
+            # names of all the files of the folder at once, so that the other
+            # files of the drop are linked without querying the server again.
+            self._prefetch_folder_names(file_item.context.project, os.path.dirname(path))
+            self._link_items_to_tasks([file_item])
             # --- end customization
             return file_item
 
     # --- Yeti - begin customization
-    def _link_item_to_task(self, file_item):
+    def _collect_folder(self, parent_item, folder):
+        """
+        Process the supplied folder, creating an item for each image sequence
+        found. Sub folders are ignored.
+
+        The folder is scanned with ``os.scandir`` and the frames are grouped
+        into sequences as they are found, so that huge plate folders never need
+        a list of every file name in memory while they are scanned. The items
+        are only created once the whole folder is scanned, since the frames of
+        a sequence can be listed in any order.
+
+        :param parent_item: The parent item for any sequences collected
+        :param folder: The folder to walk
+
+        :returns: A list of created items
+        """
+        # make sure the path is normalized. no trailing separator, separators
+        # are appropriate for the current os, no double separators, etc.
+        folder = sgtk.util.ShotgunPath.normalize(folder)
+
+        image_extensions = frozenset(ext.lower() for ext in self._get_image_extensions())
+
+        sequences = find_frame_sequences(folder, image_extensions)
+        if not sequences:
+            self.logger.warn("No image sequences found in: %s" % (folder,))
+
+        return [self._create_sequence_item(parent_item, sequence) for sequence in sequences]
+
+    def _create_sequence_item(self, parent_item, sequence):
         """
-        This function will connect the file_item with a task if one is found
-        based on the filename.
+        Create an item for the given image sequence.
+
+        :param parent_item: The parent item of the new item
+        :param sequence: The :class:`FrameSequence` to create the item for
+
+        :returns: The created item
         """
-        path = file_item.properties["path"]
         publisher = self.parent
-        sg = publisher.shotgun
-
-        # get path components assuming the file structure is
-        # single file:  LAX_0020_comp_v002.mov
-        # sequence:     LAX_0020_comp_v002.%04d.exr
-        # subtask:      LAX_0020_comp_pipe_v002.mov
-        file_name = publisher.util.get_file_path_components(path)["filename"]
-        scene, shot, task, subtask, *rest = file_name.split("_")
-
-        project_id = file_item.context.project["id"]
-        # if there is no subtask, the version and file extension are in subtask
-        # an rest is empty. Therefore, if a rest is given, we have a subtask
-        entity_name = "_".join(filter(None, [scene, shot, task, subtask if rest else None]))
-        response = sg.text_search(entity_name, {"Task": []}, [project_id])
-
-        if not response["matches"]:
-            # we did not find any tasks. search for a shot at least
-            entity_name = "_".join([scene, shot])
-            response = sg.text_search(entity_name, {"Shot": []}, [project_id])
-
-        # we can only link a task if the matches are unambiguous, therefore
-        # iterate over all of them and do a name matching
-        match = None
-        for match in response["matches"]:
-            if match["name"] == entity_name:
-                entity_type = match["type"]
-                entity_id = match["id"]
-                new_ctx = publisher.sgtk.context_from_entity(entity_type, entity_id)
+
+        # get info for the extension. the path is part of a sequence, alter the
+        # type info to account for this.
+        item_info = self._get_item_info(sequence.path)
+        type_display = "%s Sequence" % (item_info["type_display"],)
+        item_type = "%s.%s" % (item_info["item_type"], "sequence")
+
+        # the first frame of the sequence is used for the thumbnail and to
+        # generate the display name
+        first_frame_file = sequence.first_frame_path
+        display_name = publisher.util.get_publish_name(first_frame_file, sequence=True)
+
+        file_item = parent_item.create_item(item_type, type_display, display_name)
+        file_item.set_icon_from_path(self._get_icon_path("image_sequence.png"))
+
+        # use the first frame of the seq as the thumbnail and disable thumbnail
+        # creation since we get it for free
+        file_item.set_thumbnail_from_path(first_frame_file)
+        file_item.thumbnail_enabled = False
+
+        # the publish plugins expect the paths of all the frames
+        file_item.properties["path"] = sequence.path
+        file_item.properties["sequence_paths"] = list(sequence.iter_frame_paths())
+
+        self.logger.info("Collected file: %s" % (sequence.path,))
+
+        return file_item
+
+    def _link_items_to_tasks(self, file_items):
+        """
+        This function will connect each file_item with a task if one is found
+        based on the filename, or at least with the shot.
+
+        All the file names are parsed first so that the tasks and shots of the
+        whole batch can be resolved with a few bulk queries instead of one
+        search per file.
+
+        :param list file_items: The collected items to link.
+        """
+        if not file_items:
+            return
+
+        # items whose name does not follow the naming convention are still
+        # collected, they just keep their current context
+        parsed_items = []
+        paths = [file_item.properties["path"] for file_item in file_items]
+        for file_item, file_name in zip(file_items, parse_file_names(paths)):
+            if file_name is None:
+                logger.debug(
+                    f'Not linking "{file_item.properties["path"]}" to a task, its name '
+                    "does not follow the naming convention."
+                )
+                continue
+            parsed_items.append((file_item, file_name))
+
+        if not parsed_items:
+            return
+
+        project = file_items[0].context.project
+        tasks, shots = self._resolve_file_names(
+            project, [file_name for _, file_name in parsed_items]
+        )
+
+        for file_item, file_name in parsed_items:
+            # we can only link a task if the match is unambiguous, therefore
+            # only exact name matches are considered
+            task_name = file_name.task_name
+            shot_name = file_name.shot_name
+            entity_name = task_name
+            entity = tasks.get(task_name)
+            if entity:
+                entity, new_ctx = self._get_entity_context(project, entity)
+                if entity is None:
+                    # the task is gone, fall back to the shot
+                    del tasks[task_name]
+                    shots.update(self._resolve_entities(project, "Shot", {shot_name}))
+            if entity is None:
+                entity_name = shot_name
+                entity = shots.get(shot_name)
+                if entity:
+                    entity, new_ctx = self._get_entity_context(project, entity)
+            if entity:
                 file_item.context = new_ctx
 
-                logger.info(f'Successfully linked asset "{file_name}" to {entity_type} "{entity_name}"')
-                # we found a match, let"s leave now
-                break
+                logger.info(
+                    f'Successfully linked asset "{file_name.file_name}" to {entity["type"]} "{entity_name}"'
+                )
+
+            # store task information from filename for later use in upload_version
+            if entity and entity["type"] == "Task" or file_name.task in ACCEPTABLE_TYPES:
+                file_item.properties["version_type"] = file_name.task
+
+    def _get_entity_context(self, project, entity):
+        """
+        Return the context of a resolved task or shot.
+
+        The name index can hold entities retired since it was last rebuilt,
+        whose context can't be built. Such an entity is dropped from the index
+        and its name is looked up again on the server.
+
+        :param dict project: The project the entity belongs to.
+        :param dict entity: The entity dict, holding its name field.
+
+        :returns: A tuple with the entity dict the context was built from and
+            the context, or ``(None, None)`` if no entity has this name anymore.
+        """
+        publisher = self.parent
+        entity_type = entity["type"]
 
-        # store task information from filename for later use in upload_version
-        if match and match["type"] == "Task" or task in ACCEPTABLE_TYPES:
-            file_item.properties["version_type"] = task
+        context = self._context_cache.get(entity_type, entity["id"])
+        if context is not None:
+            return entity, context
+
+        try:
+            context = publisher.sgtk.context_from_entity(entity_type, entity["id"])
+        except TankError as e:
+            name_field = ENTITY_NAME_FIELDS[entity_type]
+            name = entity[name_field]
+            logger.debug(
+                f'Unable to get the context of {entity_type} "{name}", looking it up again: {e}'
+            )
+
+            name_index = self._name_indexes[project["id"]]
+            name_index.remove(entity_type, entity["id"])
+            found = self._find_entities_by_name(
+                publisher.shotgun, project, entity_type, name_field, {name}
+            ).get(name)
+            if found is None or found["id"] == entity["id"]:
+                name_index.save()
+                self._missing_names[(project["id"], entity_type)].add(name)
+                return None, None
+
+            name_index.update(entity_type, [found])
+            name_index.save()
+            entity = found
+            context = publisher.sgtk.context_from_entity(entity_type, entity["id"])
+
+        self._context_cache.add(entity_type, entity["id"], context)
+        return entity, context
+
+    def _prefetch_folder_names(self, project, folder):
+        """
+        Resolve the tasks and shots of all the files of a folder following the
+        naming convention, once per folder and session.
+
+        :param dict project: The project the entities belong to.
+        :param str folder: The folder holding the files.
+        """
+        key = (project["id"], folder)
+        if key in self._prefetched_folders:
+            return
+        self._prefetched_folders.add(key)
+
+        try:
+            with os.scandir(folder) as entries:
+                names = [entry.name for entry in entries if not entry.is_dir()]
+        except OSError as e:
+            logger.debug(f'Unable to list folder "{folder}": {e}')
+            return
+
+        self._resolve_file_names(project, [name for name in parse_file_names(names) if name])
+
+    def _resolve_file_names(self, project, file_names):
+        """
+        Resolve the tasks and shots of the given parsed file names.
+
+        The deduplicated names are resolved all at once. Shots are only needed
+        for the names we could not find a task for.
+
+        :param dict project: The project the entities belong to.
+        :param list file_names: The :class:`ParsedFileName` to resolve.
+
+        :returns: A tuple of two dicts mapping the resolved task and shot names
+            to their entity dicts.
+        """
+        tasks = self._resolve_entities(
+            project, "Task", {file_name.task_name for file_name in file_names}
+        )
+        shots = self._resolve_entities(
+            project,
+            "Shot",
+            {
+                file_name.shot_name
+                for file_name in file_names
+                if file_name.task_name not in tasks
+            },
+        )
+        return tasks, shots
+
+    def _resolve_entities(self, project, entity_type, names):
+        """
+        Resolve the given task or shot names of a project to their entities.
+
+        The project name index is consulted first. Only the names missing from
+        the index are looked up on the server, and the results are added to
+        the index for the next time. Names not found on the server are not
+        looked up again during the session.
+
+        :param dict project: The project the entities belong to.
+        :param str entity_type: Either ``Task`` or ``Shot``.
+        :param set names: The names to resolve.
+
+        :returns: A dict mapping each resolved name to its entity dict.
+        """
+        if not names:
+            return {}
+
+        name_index = self._name_indexes.get(project["id"])
+        if name_index is None:
+            name_index = EntityNameIndex(
+                self.parent.shotgun, project, self.parent.cache_location
+            )
+            self._name_indexes[project["id"]] = name_index
+
+        entities = name_index.find(entity_type, names)
+
+        known_missing_names = self._missing_names[(project["id"], entity_type)]
+        missing_names = names.difference(entities, known_missing_names)
+        if missing_names:
+            found = self._find_entities_by_name(
+                self.parent.shotgun,
+                project,
+                entity_type,
+                ENTITY_NAME_FIELDS[entity_type],
+                missing_names,
+            )
+            if found:
+                name_index.update(entity_type, found.values())
+                name_index.save()
+                entities.update(found)
+            known_missing_names.update(missing_names.difference(found))
+
+        return entities
+
+    def _find_entities_by_name(self, sg, project, entity_type, name_field, names):
+        """
+        Find all the entities of the given type on the project whose name is
+        one of the given names.
+
+        :param sg: Shotgun API instance
+        :param dict project: The project the entities belong to.
+        :param str entity_type: The entity type to look for, eg. ``Task``.
+        :param str name_field: The field holding the entity name, eg. ``content``.
+        :param set names: The names to look for.
+
+        :returns: A dict mapping each found name to its entity dict. When a
+            name is used by several entities, the newest one wins.
+        """
+        entities = {}
+        names = sorted(names)
+
+        # keep the filter lists at a reasonable size for very large drops
+        for i in range(0, len(names), NAME_QUERY_CHUNK_SIZE):
+            filters = [
+                ["project", "is", project],
+                [name_field, "in", names[i:i + NAME_QUERY_CHUNK_SIZE]],
+            ]
+            results = sg.find(
+                entity_type,
+                filters,
+                [name_field],
+                order=[{"field_name": "id", "direction": "desc"}],
+            )
+            for entity in results:
+                entities.setdefault(entity[name_field], entity)
+
+        return entities
     # --- end customization
+
+
+# --- Yeti - begin customization
+class ParsedFileName(
+    collections.namedtuple(
+        "ParsedFileName",
+        ["file_name", "scene", "shot", "task", "subtask", "version", "frame_spec", "ext"],
+    )
+):
+    """
+    The components of a file name following the naming convention.
+    """
+
+    __slots__ = ()
+
+    @property
+    def task_name(self):
+        """
+        The name of the task the file belongs to, eg. ``LAX_0020_comp_pipe``.
+        """
+        return "_".join(filter(None, [self.scene, self.shot, self.task, self.subtask]))
+
+    @property
+    def shot_name(self):
+        """
+        The name of the shot the file belongs to, eg. ``LAX_0020``.
+        """
+        return "%s_%s" % (self.scene, self.shot)
+
+
+def parse_file_names(paths):
+    """
+    Parse the file names of the given paths according to the naming convention.
+
+    :param list paths: The paths to parse.
+
+    :returns: A list holding, for each path, a :class:`ParsedFileName` or None
+        if the file name does not follow the naming convention.
+
+    >>> [f.task_name for f in parse_file_names([
+    ...     "/turnover/LAX_0020_comp_v002.mov",
+    ...     "/turnover/LAX_0020_comp_pipe_v002.mov",
+    ...     "/turnover/LAX_0020_comp_v002.%04d.exr",
+    ...     "/turnover/LAX_0020_comp_v002.final.mov",
+    ...     "/turnover/LAX_0020_comp_v002.tar.gz",
+    ...     "/turnover/LAX_0020_comp_v002",
+    ... ])]
+    ['LAX_0020_comp', 'LAX_0020_comp_pipe', 'LAX_0020_comp', 'LAX_0020_comp', 'LAX_0020_comp', 'LAX_0020_comp']
+    >>> parse_file_names(["/turnover/LAX_0020_comp_v002.1001.exr"])[0][-3:]
+    ('v002', '1001', 'exr')
+    >>> parse_file_names(["/turnover/LAX_0020_comp_v002.tar.gz"])[0].ext
+    'gz'
+    >>> parse_file_names(["/turnover/LAX_0020.mov"])
+    [None]
+    """
+    match = FILE_NAME_REGEX.match
+    basename = os.path.basename
+    matches = [(name, match(name)) for name in map(basename, paths)]
+    return [
+        ParsedFileName(name, *m.group(*ParsedFileName._fields[1:])) if m else None
+        for name, m in matches
+    ]
+
+
+def find_frame_sequences(folder, extensions):
+    """
+    Scan the given folder, grouping the frame files found into sequences.
+    Sub folders are not scanned.
+
+    :param str folder: The folder to scan.
+    :param extensions: The lower case extensions, without the dot, of the
+        frame files to consider.
+
+    :returns: The list of :class:`FrameSequence` found, sorted by path.
+    """
+    sequences = {}
+
+    try:
+        with os.scandir(folder) as entries:
+            for entry in entries:
+                if entry.is_dir():
+                    continue
+
+                match = FRAME_FILE_REGEX.match(entry.name)
+                if not match or match.group("ext")[1:].lower() not in extensions:
+                    continue
+
+                frame = match.group("frame")
+                key = (match.group("prefix"), len(frame), match.group("ext"))
+                sequence = sequences.get(key)
+                if sequence is None:
+                    sequence = sequences[key] = FrameSequence(folder, *key)
+                sequence.add_frame(int(frame))
+    except OSError as e:
+        logger.warning(f'Unable to scan folder "{folder}": {e}')
+
+    return sorted(sequences.values(), key=lambda sequence: sequence.path)
+
+
+class FrameSequence(object):
+    """
+    A sequence of frame files, eg. ``LAX_0020_plate_v001.%04d.exr``.
+
+    The frame numbers are accumulated in a compact array while the folder is
+    scanned and collapsed into a list of ``(first, last)`` ranges on first
+    access.
+    """
+
+    __slots__ = ("_folder", "_prefix", "_padding", "_ext", "_frames", "_frame_ranges")
+
+    def __init__(self, folder, prefix, padding, ext):
+        """
+        :param str folder: The folder holding the frames.
+        :param str prefix: The file name part before the frame number.
+        :param int padding: The number of digits of the frame numbers.
+        :param str ext: The file extension, including the dot.
+        """
+        self._folder = folder
+        self._prefix = prefix
+        self._padding = padding
+        self._ext = ext
+        self._frames = array.array("q")
+        self._frame_ranges = None
+
+    def add_frame(self, frame):
+        """
+        Add a frame to the sequence.
+
+        :param int frame: The frame number.
+        """
+        self._frames.append(frame)
+        self._frame_ranges = None
+
+    @property
+    def path(self):
+        """
+        The path of the sequence, using a ``%0Nd`` frame specification.
+        """
+        return os.path.join(
+            self._folder, "%s%%0%dd%s" % (self._prefix, self._padding, self._ext)
+        )
+
+    @property
+    def frame_ranges(self):
+        """
+        The sorted list of ``(first, last)`` frame ranges of the sequence.
+        """
+        if self._frame_ranges is None:
+            frame_ranges = []
+            for frame in sorted(self._frames):
+                if frame_ranges and frame <= frame_ranges[-1][1] + 1:
+                    frame_ranges[-1][1] = frame
+                else:
+                    frame_ranges.append([frame, frame])
+            self._frame_ranges = [tuple(frame_range) for frame_range in frame_ranges]
+        return self._frame_ranges
+
+    @property
+    def first_frame_path(self):
+        """
+        The path of the first frame of the sequence.
+        """
+        return self.frame_path(self.frame_ranges[0][0])
+
+    def frame_path(self, frame):
+        """
+        Return the path of the given frame.
+
+        :param int frame: The frame number.
+        """
+        return os.path.join(
+            self._folder,
+            "%s%0*d%s" % (self._prefix, self._padding, frame, self._ext),
+        )
+
+    def iter_frame_paths(self):
+        """
+        Iterate over the paths of all the frames of the sequence, in order.
+        """
+        for first, last in self.frame_ranges:
+            for frame in range(first, last + 1):
+                yield self.frame_path(frame)
+
+
+class ContextCache(object):
+    """
+    Bounded LRU cache of the contexts built from entities, keyed by
+    ``(entity_type, entity_id)``.
+
+    Hits and misses are counted so the savings can be checked on large drops.
+    """
+
+    def __init__(self, max_size):
+        """
+        :param int max_size: Maximum number of contexts kept in the cache.
+        """
+        self._max_size = max_size
+        self._contexts = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, entity_type, entity_id):
+        """
+        Return the cached context of the given entity.
+
+        :param str entity_type: The entity type.
+        :param int entity_id: The entity id.
+
+        :returns: The context, or None if it is not cached.
+        """
+        key = (entity_type, entity_id)
+        context = self._contexts.get(key)
+        if context is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self._contexts.move_to_end(key)
+        return context
+
+    def add(self, entity_type, entity_id, context):
+        """
+        Cache the context of the given entity, evicting the least recently
+        used one if the cache is full.
+
+        :param str entity_type: The entity type.
+        :param int entity_id: The entity id.
+        :param context: The context built from the entity.
+        """
+        self._contexts[(entity_type, entity_id)] = context
+        self._contexts.move_to_end((entity_type, entity_id))
+        if len(self._contexts) > self._max_size:
+            self._contexts.popitem(last=False)
+
+    def clear(self):
+        """
+        Empty the cache and reset the counters.
+        """
+        self._contexts.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class EntityNameIndex(object):
+    """
+    Persistent index mapping the task and shot names of a project to their
+    entity dicts.
+
+    The index is stored as a json file in the toolkit cache location, one file
+    per project. It is refreshed with a delta query on ``updated_at`` once it is
+    older than ``NAME_INDEX_TTL`` and rebuilt from scratch once it is older than
+    ``NAME_INDEX_REBUILD_AGE``. In between, lookups don't hit the server at all.
+    """
+
+    def __init__(self, sg, project, cache_location):
+        """
+        :param sg: Shotgun API instance
+        :param dict project: The project to index.
+        :param str cache_location: Folder the index file is stored in. If None,
+            the index only lives in memory.
+        """
+        self._sg = sg
+        self._project = project
+        self._path = None
+        if cache_location:
+            self._path = os.path.join(
+                cache_location, "entity_name_index_%d.json" % project["id"]
+            )
+
+        self._entities = {entity_type: {} for entity_type in ENTITY_NAME_FIELDS}
+        self._last_sync = None
+        self._last_rebuild = None
+        self._load()
+
+    def find(self, entity_type, names):
+        """
+        Look up the given names in the index, refreshing it first if needed.
+
+        :param str entity_type: Either ``Task`` or ``Shot``.
+        :param names: The names to look up.
+
+        :returns: A dict mapping each name found in the index to its entity dict.
+        """
+        self._sync()
+        entities = self._entities[entity_type]
+        return {name: entities[name] for name in names if name in entities}
+
+    def update(self, entity_type, entities):
+        """
+        Add or update entities in the index.
+
+        :param str entity_type: Either ``Task`` or ``Shot``.
+        :param entities: The entity dicts, holding at least the name field.
+        """
+        name_field = ENTITY_NAME_FIELDS[entity_type]
+        index = self._entities[entity_type]
+        entities = list(entities)
+
+        # drop the previous names of the entities that were renamed
+        updated_ids = {entity["id"] for entity in entities}
+        for name in [name for name, entity in index.items() if entity["id"] in updated_ids]:
+            del index[name]
+
+        for entity in entities:
+            name = entity[name_field]
+            # when a name is used by several entities, the newest one wins, e.g.
+            # a task recreated after the previous one was deleted
+            existing = index.get(name)
+            if existing is None or entity["id"] > existing["id"]:
+                index[name] = {"type": entity["type"], "id": entity["id"], name_field: name}
+
+    def remove(self, entity_type, entity_id):
+        """
+        Remove an entity from the index, e.g. because it was retired. Retired
+        entities are otherwise only dropped when the index is rebuilt.
+
+        :param str entity_type: Either ``Task`` or ``Shot``.
+        :param int entity_id: The id of the entity.
+        """
+        index = self._entities[entity_type]
+        for name in [name for name, entity in index.items() if entity["id"] == entity_id]:
+            del index[name]
+
+    def save(self):
+        """
+        Write the index to disk. Failures are logged but not raised since the
+        index can always be rebuilt from the server.
+        """
+        if not self._path:
+            return
+
+        data = {
+            "project_id": self._project["id"],
+            "last_sync": self._last_sync.isoformat(),
+            "last_rebuild": self._last_rebuild.isoformat(),
+            "entities": self._entities,
+        }
+
+        # write to a temporary file first so that concurrent publishers never
+        # read a partially written index
+        tmp_path = "%s.%d.tmp" % (self._path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(self._path)):
+                os.makedirs(os.path.dirname(self._path))
+            with open(tmp_path, "w") as fp:
+                json.dump(data, fp)
+            os.replace(tmp_path, self._path)
+        except (IOError, OSError) as e:
+            logger.warning(f'Unable to save the entity name index "{self._path}": {e}')
+
+    def _load(self):
+        """
+        Read the index from disk, if any.
+        """
+        if not self._path or not os.path.exists(self._path):
+            return
+
+        try:
+            with open(self._path, "r") as fp:
+                data = json.load(fp)
+            entities = data["entities"]
+            last_sync = datetime.datetime.fromisoformat(data["last_sync"])
+            last_rebuild = datetime.datetime.fromisoformat(data["last_rebuild"])
+        except (IOError, OSError, ValueError, KeyError, TypeError) as e:
+            # the index will be rebuilt on the next lookup
+            logger.debug(f'Ignoring invalid entity name index "{self._path}": {e}')
+            return
+
+        for entity_type in ENTITY_NAME_FIELDS:
+            self._entities[entity_type] = entities.get(entity_type, {})
+        self._last_sync = last_sync
+        self._last_rebuild = last_rebuild
+
+    def _sync(self):
+        """
+        Rebuild or refresh the index from the server when it is too old.
+        """
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        if (
+            self._last_rebuild is None
+            or (now - self._last_rebuild).total_seconds() > NAME_INDEX_REBUILD_AGE
+        ):
+            logger.debug(f'Rebuilding the entity name index of project {self._project["id"]}')
+            for entity_type in ENTITY_NAME_FIELDS:
+                self._entities[entity_type] = {}
+                self.update(entity_type, self._query(entity_type))
+            self._last_rebuild = now
+
+        elif (now - self._last_sync).total_seconds() > NAME_INDEX_TTL:
+            logger.debug(f'Refreshing the entity name index of project {self._project["id"]}')
+            updated_since = ["updated_at", "greater_than", self._last_sync - NAME_INDEX_SYNC_MARGIN]
+            for entity_type in ENTITY_NAME_FIELDS:
+                self.update(entity_type, self._query(entity_type, [updated_since]))
+
+        else:
+            return
+
+        self._last_sync = now
+        self.save()
+
+    def _query(self, entity_type, filters=None):
+        """
+        Find the entities of the given type on the project.
+
+        :param str entity_type: Either ``Task`` or ``Shot``.
+        :param list filters: Additional filters to apply.
+
+        :returns: The list of entity dicts found.
+        """
+        name_field = ENTITY_NAME_FIELDS[entity_type]
+        return self._sg.find(
+            entity_type,
+            [["project", "is", self._project]] + (filters or []),
+            [name_field],
+        )
+# --- end customization
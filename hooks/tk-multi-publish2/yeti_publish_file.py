@@ -4,14 +4,38 @@
 
 import os
 import pprint
+import threading
+import time
 import traceback
 
 import sgtk
 from sgtk.util.filesystem import copy_file, ensure_folder_exists
 from sgtk.platform.qt import QtGui, QtCore
 
+logger = sgtk.platform.get_logger(__name__)
+
 HookBaseClass = sgtk.get_hook_baseclass()
 
+# time in seconds during which the artists and playlists found for a project
+# are reused by the review widgets
+REVIEW_DATA_TTL = 5 * 60
+
+# artists and playlists found, per (kind, project id), with the time they were found
+_review_data_cache = {}
+_review_data_lock = threading.Lock()
+
+# number of artists or playlists fetched per request. the first page is loaded
+# with the widget, the others are searched for as the user types.
+REVIEW_PAGE_SIZE = 200
+
+# maximum number of suggestions shown while typing, and delay in milliseconds
+# after the last keystroke before searching on the server
+REVIEW_COMPLETION_LIMIT = 50
+REVIEW_SEARCH_DELAY = 300
+
+# field displayed for each kind of entity listed in the review widget
+REVIEW_DISPLAY_FIELDS = {"artists": "name", "playlists": "code"}
+
 
 class BasicFilePublishPlugin(HookBaseClass):
 
@@ -36,7 +60,7 @@ class BasicFilePublishPlugin(HookBaseClass):
     def create_settings_widget(self, parent):
         # Create our custom widget and return it.
         # It is actually a collection of widgets parented to a single widget.
-        self.review_widget = ReviewWidget(parent, self.parent.shotgun)
+        self.review_widget = ReviewWidget(parent)
         return self.review_widget
 
 
@@ -73,14 +97,35 @@ class BasicFilePublishPlugin(HookBaseClass):
 
 class ReviewWidget(QtGui.QWidget):
 
-    def __init__(self, parent, sg):
+    # emitted from the loading threads with the kind of data, the entities
+    # found and whether all the entities of the project were found
+    _data_loaded = QtCore.Signal(str, object, bool)
+
+    def __init__(self, parent):
 
         super(ReviewWidget, self).__init__(parent)
 
         self._setup_ui()
 
-        self._populate_artists(sg, self.artist_cmbx)
-        self._populate_playlists(sg, self.playlist_cmbx)
+        # the entities are found in background threads, the values set before
+        # they arrive are applied once the combo boxes are populated
+        self._comboboxes = {"artists": self.artist_cmbx, "playlists": self.playlist_cmbx}
+        self._indexes = {
+            kind: EntitySearchIndex(display_field)
+            for kind, display_field in REVIEW_DISPLAY_FIELDS.items()
+        }
+        self._loaded = set()
+        self._complete = set()
+        self._pending_values = {}
+        self._completions = {}
+        self._data_loaded.connect(self._on_data_loaded)
+
+        self._project = sgtk.platform.current_engine().context.project
+        self._find_methods = {"artists": self._find_artists, "playlists": self._find_playlists}
+        self._setup_type_ahead()
+
+        for kind in self._comboboxes:
+            self._load_data(kind)
 
     @property
     def artist(self):
@@ -89,8 +134,7 @@ class ReviewWidget(QtGui.QWidget):
         Should return something like {u'type': u'HumanUser', u'id': 190, u'name': u'Bob'}.
         :return: dict
         """
-        index = self.artist_cmbx.currentIndex()
-        return self.artist_cmbx.itemData(index)
+        return self._get_value("artists")
 
     @artist.setter
     def artist(self, value):
@@ -100,8 +144,7 @@ class ReviewWidget(QtGui.QWidget):
         :param value:
         :return: Void
         """
-        index = self.artist_cmbx.findData(value)
-        self.artist_cmbx.setCurrentIndex(index)
+        self._set_value("artists", value)
 
     @property
     def playlist(self):
@@ -110,8 +153,7 @@ class ReviewWidget(QtGui.QWidget):
         Should return something like {u'type': u'HumanUser', u'id': 190, u'name': u'Bob'}.
         :return: dict
         """
-        index = self.playlist_cmbx.currentIndex()
-        return self.playlist_cmbx.itemData(index)
+        return self._get_value("playlists")
 
     @playlist.setter
     def playlist(self, value):
@@ -121,8 +163,46 @@ class ReviewWidget(QtGui.QWidget):
         :param value:
         :return: Void
         """
-        index = self.playlist_cmbx.findData(value)
-        self.playlist_cmbx.setCurrentIndex(index)
+        self._set_value("playlists", value)
+
+    def _get_value(self, kind):
+        """
+        Return the data of the current item of a combobox, or the value set
+        while it was still loading.
+        :param kind: Either "artists" or "playlists".
+        :return: dict
+        """
+        if kind not in self._loaded:
+            return self._pending_values.get(kind)
+
+        combobox = self._comboboxes[kind]
+        return combobox.itemData(combobox.currentIndex())
+
+    def _set_value(self, kind, value):
+        """
+        Select the combobox item matching the given data. If the combobox is
+        still loading, the value is applied once it is populated.
+        :param kind: Either "artists" or "playlists".
+        :param value: The entity dict to select.
+        :return: Void
+        """
+        if kind not in self._loaded:
+            self._pending_values[kind] = value
+            return
+
+        combobox = self._comboboxes[kind]
+        if not value:
+            combobox.setCurrentIndex(0)
+            return
+
+        # the entity may not be part of the loaded pages, the settings hold
+        # everything needed to add it
+        index = self._indexes[kind]
+        if index.row(value["id"]) is None:
+            self._add_entities(kind, [value])
+
+        # the first row is the "---" option
+        combobox.setCurrentIndex(index.row(value["id"]) + 1)
 
     def _setup_ui(self):
         """
@@ -132,21 +212,200 @@ class ReviewWidget(QtGui.QWidget):
         self.artist_cmbx = QtGui.QComboBox()
         self.playlist_cmbx = QtGui.QComboBox()
 
+        # Add an option so the user doesn't have to assign to someone.
+        self.artist_cmbx.addItem("---")
+        self.playlist_cmbx.addItem("---")
+
         layout = QtGui.QFormLayout()
         layout.addRow("Artist", self.artist_cmbx)
         layout.addRow("Playlist", self.playlist_cmbx)
         self.setLayout(layout)
 
-    def _populate_artists(self, sg, combobox):
+    def _setup_type_ahead(self):
         """
-        Populate the artist combobox with all the available artists found on the project.
-        :param sg: Shotgun API instance
-        :param combobox: The QCombobox that should be populated with users.
+        Make the combo boxes editable, suggesting the matching entities as the
+        user types.
+        :return:
+        """
+        self._search_timers = {}
+        for kind, combobox in self._comboboxes.items():
+            combobox.setEditable(True)
+            combobox.setInsertPolicy(QtGui.QComboBox.NoInsert)
+
+            # the suggestions come from the search index, the completer must
+            # not filter them any further
+            completer = QtGui.QCompleter(QtGui.QStringListModel(self), self)
+            completer.setCompletionMode(QtGui.QCompleter.UnfilteredPopupCompletion)
+            completer.activated[str].connect(
+                lambda text, kind=kind: self._on_completion_activated(kind, text)
+            )
+            combobox.setCompleter(completer)
+
+            timer = QtCore.QTimer(self)
+            timer.setSingleShot(True)
+            timer.setInterval(REVIEW_SEARCH_DELAY)
+            timer.timeout.connect(lambda kind=kind: self._search_remote(kind))
+            self._search_timers[kind] = timer
+
+            combobox.lineEdit().textEdited.connect(
+                lambda text, kind=kind: self._on_text_edited(kind)
+            )
+
+    def _on_text_edited(self, kind):
+        """
+        Update the suggestions for the typed text, and search the server for
+        more once the user stops typing if not all the entities are loaded.
+        :param kind: Either "artists" or "playlists".
+        :return: Void
+        """
+        self._update_completions(kind)
+        if kind not in self._complete:
+            self._search_timers[kind].start()
+
+    def _update_completions(self, kind):
+        """
+        Show the entities matching the typed text as suggestions.
+        :param kind: Either "artists" or "playlists".
+        :return: Void
+        """
+        combobox = self._comboboxes[kind]
+        text = combobox.lineEdit().text()
+        if not text:
+            return
+
+        display_field = REVIEW_DISPLAY_FIELDS[kind]
+        matches = self._indexes[kind].search(text, REVIEW_COMPLETION_LIMIT)
+        self._completions[kind] = matches
+
+        completer = combobox.completer()
+        completer.model().setStringList([entity[display_field] for entity in matches])
+        if matches and combobox.lineEdit().hasFocus():
+            completer.complete()
+
+    def _on_completion_activated(self, kind, text):
+        """
+        Select the entity of the chosen suggestion.
+        :param kind: Either "artists" or "playlists".
+        :param text: The chosen suggestion.
         :return: Void
         """
+        display_field = REVIEW_DISPLAY_FIELDS[kind]
+        for entity in self._completions.get(kind, []):
+            if entity[display_field] == text:
+                self._set_value(kind, entity)
+                break
 
-        # Get the current scene context
-        current_context = sgtk.platform.current_engine().context
+    def _search_remote(self, kind):
+        """
+        Search the server for the entities matching the typed text.
+        :param kind: Either "artists" or "playlists".
+        :return: Void
+        """
+        text = self._comboboxes[kind].lineEdit().text()
+        if text:
+            self._start_thread(kind, text)
+
+    def _load_data(self, kind):
+        """
+        Populate a combobox with the first page of entities found for the
+        project, from the cache if they were found recently or from a
+        background thread otherwise.
+        :param kind: Either "artists" or "playlists".
+        :return: Void
+        """
+        with _review_data_lock:
+            cached = _review_data_cache.get((kind, self._project["id"]))
+        if cached and time.time() - cached[0] < REVIEW_DATA_TTL:
+            self._on_data_loaded(kind, cached[1], cached[2])
+            return
+
+        self._start_thread(kind, None)
+
+    def _start_thread(self, kind, text):
+        """
+        Find entities in a background thread.
+        :param kind: Either "artists" or "playlists".
+        :param text: Text the entity names must contain, or None to find the
+            first page of entities.
+        :return: Void
+        """
+        # the shotgun connection can't be shared between threads, the loading
+        # thread creates its own from the current user
+        thread = threading.Thread(
+            target=self._load_in_thread,
+            args=(kind, text, sgtk.get_authenticated_user()),
+        )
+        thread.daemon = True
+        thread.start()
+
+    def _load_in_thread(self, kind, text, user):
+        """
+        Find the entities in a background thread and hand them over to the
+        main thread.
+        :return: Void
+        """
+        try:
+            entities = self._find_methods[kind](user.create_sg_connection(), self._project, text)
+        except Exception as e:
+            logger.warning("Unable to load the %s of the project: %s" % (kind, e))
+            return
+
+        # a page which is not full holds all the remaining entities
+        complete = text is None and len(entities) < REVIEW_PAGE_SIZE
+        if text is None:
+            with _review_data_lock:
+                _review_data_cache[(kind, self._project["id"])] = (time.time(), entities, complete)
+
+        try:
+            self._data_loaded.emit(kind, entities, complete)
+        except RuntimeError:
+            # the widget was deleted in the meantime
+            pass
+
+    def _on_data_loaded(self, kind, entities, complete):
+        """
+        Add the found entities to a combobox and apply the value set while it
+        was loading.
+        :param kind: Either "artists" or "playlists".
+        :param entities: The list of entity dicts to add.
+        :param complete: Whether all the entities of the project were found.
+        :return: Void
+        """
+        self._add_entities(kind, entities)
+        if complete:
+            self._complete.add(kind)
+
+        if kind not in self._loaded:
+            self._loaded.add(kind)
+            if kind in self._pending_values:
+                self._set_value(kind, self._pending_values.pop(kind))
+        else:
+            self._update_completions(kind)
+
+    def _add_entities(self, kind, entities):
+        """
+        Add the entities which are not listed yet to a combobox.
+        :param kind: Either "artists" or "playlists".
+        :param entities: The list of entity dicts to add.
+        :return: Void
+        """
+        combobox = self._comboboxes[kind]
+        display_field = REVIEW_DISPLAY_FIELDS[kind]
+
+        # adding items may change the text being edited, preserve it
+        text = combobox.lineEdit().text()
+        for entity in self._indexes[kind].add(entities):
+            combobox.addItem(entity[display_field], entity)
+        combobox.lineEdit().setText(text)
+
+    def _find_artists(self, sg, project, text=None):
+        """
+        Find a page of the available artists on the project.
+        :param sg: Shotgun API instance
+        :param project: The project to find the artists for.
+        :param text: Optional text the artist names must contain.
+        :return: list of HumanUser dicts
+        """
 
         # Instead of hardcoding the artist group id, we could find it by name, which causes
         # another request, or specify it in settings maybe.
@@ -155,37 +414,120 @@ class ReviewWidget(QtGui.QWidget):
         #group = ["groups", "is", {"type":"Group", "id": 5}]
 
         # only find people assigned to the current project
-        project = ["projects", "is", current_context.project]
-
-        artists = sg.find("HumanUser", filters=[project], fields=["name"])
-
-        # Add an option so the user doesn't have to assign to someone.
-        combobox.addItem("---")
-
-        # Now add all the found users to the artist combo box.
-        for artist in artists:
-            combobox.addItem(artist["name"], artist)
-
-    def _populate_playlists(self, sg, combobox):
+        filters = [["projects", "is", project]]
+        if text:
+            filters.append(["name", "contains", text])
+
+        return sg.find(
+            "HumanUser",
+            filters=filters,
+            fields=["name"],
+            order=[{"field_name": "name", "direction": "asc"}],
+            limit=REVIEW_PAGE_SIZE,
+        )
+
+    def _find_playlists(self, sg, project, text=None):
         """
-        Populate the playlist combobox with all the available playlists found on the project.
+        Find a page of the open playlists on the project, sorted by code.
         :param sg: Shotgun API instance
-        :param combobox: The QCombobox that should be populated with users.
-        :return: Void
+        :param project: The project to find the playlists for.
+        :param text: Optional text the playlist codes must contain.
+        :return: list of Playlist dicts
         """
 
-        # Get the current scene context
-        current_context = sgtk.platform.current_engine().context
-
         # only find playlists assigned to the current project
-        status = ["sg_playlist_status", "not_in", ("clsd", "dlvr", "cmpt")]
-        project = ["project", "is", current_context.project]
-
-        playlists = sg.find("Playlist", filters=[status, project], fields=["id", "code"])
+        filters = [
+            ["sg_playlist_status", "not_in", ("clsd", "dlvr", "cmpt")],
+            ["project", "is", project],
+        ]
+        if text:
+            filters.append(["code", "contains", text])
+
+        return sg.find(
+            "Playlist",
+            filters=filters,
+            fields=["id", "code"],
+            order=[{"field_name": "code", "direction": "asc"}],
+            limit=REVIEW_PAGE_SIZE,
+        )
+
+
+class EntitySearchIndex(object):
+    """
+    In-memory index over the names of the entities listed in a combobox.
+
+    Rows are looked up by entity id in constant time. Names are searched with
+    word prefixes for short texts and with trigrams for longer ones, so that
+    the whole list never needs to be scanned.
+    """
+
+    def __init__(self, display_field):
+        """
+        :param display_field: The entity field holding the name to index.
+        """
+        self._display_field = display_field
+        self._entities = []
+        self._rows = {}
+        self._prefixes = {}
+        self._trigrams = {}
 
-        # Add an option so the user doesn't have to assign to someone.
-        combobox.addItem("---")
+    def add(self, entities):
+        """
+        Add entities to the index, ignoring the ones already indexed.
+        :param entities: The entity dicts to add.
+        :return: The list of added entities, in the order of their rows.
+        """
+        added = []
+        for entity in entities:
+            if entity["id"] in self._rows:
+                continue
+
+            row = len(self._entities)
+            self._entities.append(entity)
+            self._rows[entity["id"]] = row
+            added.append(entity)
+
+            name = (entity.get(self._display_field) or "").lower()
+            for word in name.split():
+                for length in (1, 2):
+                    self._prefixes.setdefault(word[:length], set()).add(row)
+            for i in range(len(name) - 2):
+                self._trigrams.setdefault(name[i:i + 3], set()).add(row)
+
+        return added
+
+    def row(self, entity_id):
+        """
+        Return the row of the given entity, or None if it is not indexed.
+        :param entity_id: The entity id.
+        :return: int
+        """
+        return self._rows.get(entity_id)
 
-        # Now add all the found users to the playlist combo box.
-        for playlist in sorted(playlists, key=lambda pl: pl["code"]):
-            combobox.addItem(playlist["code"], playlist)
+    def search(self, text, limit):
+        """
+        Find the entities whose name contains the given text. Texts shorter
+        than three characters match the beginning of the name words.
+        :param text: The text to search for.
+        :param limit: The maximum number of entities returned.
+        :return: The list of matching entities, in the order of their rows.
+        """
+        text = text.lower()
+        if len(text) < 3:
+            rows = self._prefixes.get(text, set())
+        else:
+            trigram_rows = [
+                self._trigrams.get(text[i:i + 3], set()) for i in range(len(text) - 2)
+            ]
+            rows = set.intersection(*sorted(trigram_rows, key=len))
+
+        matches = []
+        for row in sorted(rows):
+            entity = self._entities[row]
+            # the trigrams may all be found without the text itself being found
+            if text in (entity.get(self._display_field) or "").lower():
+                matches.append(entity)
+                if len(matches) == limit:
+                    break
+
+        return matches
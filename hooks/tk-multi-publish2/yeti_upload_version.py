@@ -2,19 +2,130 @@
 #
 # CONFIDENTIAL AND PROPRIETARY
 
+import hashlib
+import json
+import mimetypes
+import mmap
 import os
 import pprint
+import threading
+import time
+import urllib.parse
+from concurrent import futures
+
 import sgtk
+from tank import TankError
 from tank_vendor import six
 
+logger = sgtk.platform.get_logger(__name__)
+
 HookBaseClass = sgtk.get_hook_baseclass()
 
+# size of the chunks read when hashing files, and size above which files are
+# memory mapped instead
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+HASH_MMAP_THRESHOLD = 64 * 1024 * 1024
+
+# size of the parts of resumable uploads. cloud storage requires parts of at
+# least 5 MB, except for the last one.
+UPLOAD_CHUNK_SIZE = 20 * 1024 * 1024
+
+# number of times a part of a resumable upload is retried, and delay in seconds
+# before the first retry. the delay doubles after each attempt.
+UPLOAD_MAX_RETRIES = 5
+UPLOAD_RETRY_DELAY = 2
+
+# number of days after which the state of an interrupted upload is discarded
+UPLOAD_STATE_MAX_AGE = 7
+
 
 class UploadVersionPlugin(HookBaseClass):
     """
     Plugin for sending quicktimes and images to shotgun for review.
     """
 
+    def __init__(self, *args, **kwargs):
+        super(UploadVersionPlugin, self).__init__(*args, **kwargs)
+
+        # --- Yeti - begin customization
+        # versions waiting to be created in concurrent upload mode, in publish order
+        self._pending_versions = []
+        # uploads running in concurrent upload mode, per item
+        self._upload_futures = {}
+        self._upload_executor = None
+        self._upload_connections = threading.local()
+        # last phase the plugin ran, used to detect the start of a new publish
+        self._phase = None
+        # --- end customization
+
+    @property
+    def settings(self):
+        """
+        Dictionary defining the settings that this plugin expects to receive
+        through the settings parameter in the accept, validate, publish and
+        finalize methods.
+        """
+        settings = super(UploadVersionPlugin, self).settings or {}
+
+        # --- Yeti - begin customization
+        settings["Concurrent Upload"] = {
+            "type": "bool",
+            "default": False,
+            "description": "Create all the Versions with a single batch request "
+            "during finalize and upload their content in parallel.",
+        }
+        settings["Upload Threads"] = {
+            "type": "int",
+            "default": 4,
+            "description": "Maximum number of uploads running at the same time "
+            "in concurrent upload mode.",
+        }
+        settings["Resumable Upload"] = {
+            "type": "bool",
+            "default": False,
+            "description": "Upload the content in chunks, retrying failed chunks "
+            "and resuming interrupted uploads where they stopped.",
+        }
+        settings["Deduplicate Uploads"] = {
+            "type": "bool",
+            "default": False,
+            "description": "Hash the uploaded file and reuse the existing Version "
+            "when the same content was already uploaded, instead of creating a "
+            "new Version and uploading it again.",
+        }
+        settings["Content Hash Field"] = {
+            "type": "str",
+            "default": None,
+            "description": "Optional Version text field storing the hash of the "
+            "uploaded content, used to find duplicates uploaded from other "
+            "machines.",
+        }
+        # --- end customization
+
+        return settings
+
+    # --- Yeti - begin customization
+    def validate(self, settings, item):
+        """
+        Validates the given item to check that it is ok to publish.
+
+        Every publish run starts with the validation of its items, the Versions
+        left queued by a previous run which didn't reach finalize are dropped.
+
+        :param settings: Dictionary of Settings. The keys are strings, matching
+            the keys returned in the settings property. The values are `Setting`
+            instances.
+        :param item: Item to process
+
+        :returns: True if item is valid, False otherwise.
+        """
+        if self._phase != "validate":
+            self._reset_pending_versions()
+        self._phase = "validate"
+
+        return super(UploadVersionPlugin, self).validate(settings, item)
+    # --- end customization
+
     def publish(self, settings, item):
         """
         Executes the publish logic for the given item and settings.
@@ -28,6 +139,11 @@ class UploadVersionPlugin(HookBaseClass):
         publisher = self.parent
         path = item.properties["path"]
 
+        # --- Yeti - begin customization
+        self._phase = "publish"
+        item.properties.pop("sg_version_error", None)
+        # --- end customization
+
         # allow the publish name to be supplied via the item properties. this is
         # useful for collectors that have access to templates and can determine
         # publish information about the item that doesn't require further, fuzzy
@@ -89,9 +205,57 @@ class UploadVersionPlugin(HookBaseClass):
             },
         )
 
-        # Create the version
-        version = publisher.shotgun.create("Version", version_data)
-        self.logger.info("Version created!")
+        # --- Yeti - begin customization
+        if settings["Deduplicate Uploads"].value and settings["Upload"].value:
+            content_hash = hash_file(path)
+            item.properties["sg_content_hash"] = content_hash
+            item.properties["sg_content_hash_key"] = self._get_hash_index_key(
+                content_hash, version_data
+            )
+
+            hash_field = settings["Content Hash Field"].value
+            version = self._find_version_by_hash(content_hash, version_data, hash_field)
+            if version:
+                self._update_duplicate_version(version, version_data)
+                item.properties["sg_version_data"] = version
+                self.logger.info(
+                    "Same content already uploaded to Version %s, skipping upload."
+                    % (version["id"],)
+                )
+                return
+
+        # reuse the Version of an interrupted upload of the same file, so that its
+        # upload resumes where it stopped
+        version = None
+        if settings["Upload"].value and settings["Resumable Upload"].value:
+            version = self._find_pending_upload_version(path)
+            if version:
+                self._update_duplicate_version(version, version_data)
+                self.logger.info(
+                    "Resuming the interrupted upload to Version %s." % (version["id"],)
+                )
+
+        if settings["Concurrent Upload"].value:
+            # the thumbnail may have to be written by Qt, get it while we are
+            # still on the main thread
+            self._pending_versions.append(
+                (
+                    item,
+                    version_data,
+                    version,
+                    settings["Upload"].value,
+                    settings["Resumable Upload"].value,
+                    item.get_thumbnail_as_path(),
+                )
+            )
+            self.logger.info("Version queued for creation and upload.")
+            return
+
+        if version is None:
+            # Create the version
+            version = publisher.shotgun.create("Version", version_data)
+            self.logger.info("Version created!")
+        # --- end customization
 
         # stash the version info in the item just in case
         item.properties["sg_version_data"] = version
@@ -101,16 +265,16 @@ class UploadVersionPlugin(HookBaseClass):
         if settings["Upload"].value:
             self.logger.info("Uploading content...")
 
-            # on windows, ensure the path is utf-8 encoded to avoid issues with
-            # the shotgun api
-            if sgtk.util.is_windows():
-                upload_path = six.ensure_text(path)
-            else:
-                upload_path = path
-
-            self.parent.shotgun.upload(
-                "Version", version["id"], upload_path, "sg_uploaded_movie"
+            # --- Yeti - begin customization
+            self._upload_movie(
+                self.parent.shotgun,
+                version["id"],
+                self._get_upload_path(path),
+                settings["Resumable Upload"].value,
+                self._log_upload_progress,
             )
+            self._remember_version_hash(item, version, settings["Content Hash Field"].value)
+            # --- end customization
         elif thumb:
             # only upload thumb if we are not uploading the content. with
             # uploaded content, the thumb is automatically extracted.
@@ -118,3 +282,647 @@ class UploadVersionPlugin(HookBaseClass):
             self.parent.shotgun.upload_thumbnail("Version", version["id"], thumb)
 
         self.logger.info("Upload complete!")
+
+    # --- Yeti - begin customization
+    def finalize(self, settings, item):
+        """
+        Execute the finalization pass. This pass executes once all the publish
+        tasks have completed, and can for example be used to version up files.
+
+        :param settings: Dictionary of Settings. The keys are strings, matching
+            the keys returned in the settings property. The values are `Setting`
+            instances.
+        :param item: Item to process
+        """
+        self._phase = "finalize"
+
+        if settings["Concurrent Upload"].value:
+            # the first item to be finalized creates the versions of all the
+            # queued items and starts their uploads
+            if self._pending_versions:
+                self._create_pending_versions(settings["Upload Threads"].value)
+
+            upload_future = self._upload_futures.pop(id(item), None)
+            try:
+                if "sg_version_error" in item.properties:
+                    raise TankError(
+                        "Unable to create the Version for %s: %s"
+                        % (item.name, item.properties["sg_version_error"])
+                    )
+
+                if upload_future:
+                    try:
+                        upload_future.result()
+                    except Exception as e:
+                        # fail this item only, the other uploads carry on
+                        item.properties["sg_upload_error"] = str(e)
+                        raise TankError("Upload failed for %s: %s" % (item.name, e))
+                    self.logger.info("Upload complete!")
+
+                    self._remember_version_hash(
+                        item,
+                        item.properties["sg_version_data"],
+                        settings["Content Hash Field"].value,
+                    )
+            finally:
+                if not self._upload_futures and self._upload_executor:
+                    self._upload_executor.shutdown()
+                    self._upload_executor = None
+
+        super(UploadVersionPlugin, self).finalize(settings, item)
+
+    def _create_pending_versions(self, max_workers):
+        """
+        Create the queued versions with a single batch request, then upload
+        their content on a pool of threads.
+
+        :param int max_workers: Maximum number of concurrent uploads.
+        """
+        pending_versions = self._pending_versions
+        self._pending_versions = []
+
+        # versions of interrupted uploads are reused instead of created
+        requests = [
+            {"request_type": "create", "entity_type": "Version", "data": version_data}
+            for _, version_data, version, _, _, _ in pending_versions
+            if version is None
+        ]
+        created_versions = []
+        if requests:
+            self.logger.info("Creating %d Versions..." % len(requests))
+            try:
+                created_versions = self.parent.shotgun.batch(requests)
+            except Exception as e:
+                # each item fails when it is finalized
+                self.logger.error("Unable to create the Versions: %s" % (e,))
+                for item, _, version, _, _, _ in pending_versions:
+                    if version is None:
+                        item.properties["sg_version_error"] = str(e)
+                pending_versions = [entry for entry in pending_versions if entry[2]]
+            else:
+                self.logger.info("Versions created!")
+        created_versions = iter(created_versions)
+
+        if self._upload_executor is None:
+            self._upload_executor = futures.ThreadPoolExecutor(max_workers=max_workers)
+
+        # the shotgun connections can't be shared between threads, each worker
+        # creates its own from the current user
+        user = sgtk.get_authenticated_user()
+
+        for item, _, version, upload, resumable, thumb in pending_versions:
+            if version is None:
+                version = next(created_versions)
+
+            # stash the version info in the item just in case
+            item.properties["sg_version_data"] = version
+
+            if upload:
+                upload_path = self._get_upload_path(item.properties["path"])
+            elif thumb:
+                # only upload thumb if we are not uploading the content. with
+                # uploaded content, the thumb is automatically extracted.
+                upload_path = thumb
+            else:
+                continue
+
+            self._upload_futures[id(item)] = self._upload_executor.submit(
+                self._upload_in_thread, user, version["id"], upload_path, upload, resumable
+            )
+
+    def _reset_pending_versions(self):
+        """
+        Drop the Versions queued and the uploads started by a previous publish run.
+        """
+        self._pending_versions = []
+
+        for upload_future in self._upload_futures.values():
+            upload_future.cancel()
+        self._upload_futures = {}
+
+    def _find_pending_upload_version(self, path):
+        """
+        Find the Version an interrupted resumable upload of the file was uploading to.
+
+        :param str path: The file to upload.
+
+        :returns: The Version entity dict, or None if there is no interrupted upload.
+        """
+        upload = ResumableUpload(self.parent.shotgun, self._get_upload_state_folder())
+        entity = upload.get_pending_entity(self._get_upload_path(path), "sg_uploaded_movie")
+        if not entity or entity["type"] != "Version":
+            return None
+
+        # make sure the Version was not deleted in the meantime
+        return self.parent.shotgun.find_one("Version", [["id", "is", entity["id"]]])
+
+    def _find_version_by_hash(self, content_hash, version_data, hash_field):
+        """
+        Find the Version the same content was already uploaded to for the Version
+        that would be created.
+
+        The local hash index is checked first, then the hash field of the
+        Versions if one is configured. Only a Version with an uploaded movie and
+        the same project, entity and code is returned: the same content, e.g. a
+        slate, published for another shot must get its own Version.
+
+        :param str content_hash: The hash of the content to upload.
+        :param dict version_data: The data of the Version that would be created.
+        :param str hash_field: The Version field storing the content hash, or None.
+
+        :returns: The Version entity dict, or None if no Version was found.
+        """
+        sg = self.parent.shotgun
+        filters = [
+            ["project", "is", version_data["project"]],
+            ["entity", "is", version_data["entity"]],
+            ["code", "is", version_data["code"]],
+            ["sg_uploaded_movie", "is_not", None],
+        ]
+
+        version = self._load_hash_index().get(
+            self._get_hash_index_key(content_hash, version_data)
+        )
+        if version:
+            # make sure the Version was not deleted or changed in the meantime
+            version = sg.find_one("Version", [["id", "is", version["id"]]] + filters)
+            if version:
+                return version
+
+        if hash_field:
+            return sg.find_one("Version", [[hash_field, "is", content_hash]] + filters)
+
+        return None
+
+    def _get_hash_index_key(self, content_hash, version_data):
+        """
+        Return the key of the local hash index for content uploaded to a Version,
+        made of the hash and of the fields identifying the Version.
+
+        :param str content_hash: The hash of the content.
+        :param dict version_data: The data of the Version.
+        """
+        key_parts = [content_hash, version_data["code"]]
+        for field in ("project", "entity"):
+            entity = version_data.get(field)
+            key_parts.append("%s:%s" % (entity["type"], entity["id"]) if entity else "")
+        return "|".join(key_parts)
+
+    def _update_duplicate_version(self, version, version_data):
+        """
+        Update an existing Version with the data of the Version that would have
+        been created for the same content, or for the same interrupted upload.
+
+        :param dict version: The existing Version.
+        :param dict version_data: The data of the Version that was not created.
+        """
+        update_data = {
+            field: value
+            for field, value in version_data.items()
+            if field not in ("project", "code", "entity")
+        }
+        self.parent.shotgun.update(
+            "Version",
+            version["id"],
+            update_data,
+            multi_entity_update_modes={"published_files": "add", "playlists": "add"},
+        )
+
+    def _remember_version_hash(self, item, version, hash_field):
+        """
+        Record the hash of the content uploaded for the item in the local hash
+        index and in the hash field of its Version, if its content was hashed.
+
+        This must only be called once the upload succeeded, so that a Version
+        without media is never reused.
+
+        :param item: The item the Version was created for.
+        :param dict version: The created Version.
+        :param str hash_field: The Version field storing the content hash, or None.
+        """
+        content_hash = item.properties.get("sg_content_hash")
+        if not content_hash:
+            return
+
+        if hash_field:
+            self.parent.shotgun.update("Version", version["id"], {hash_field: content_hash})
+
+        hash_index = self._load_hash_index()
+        hash_index[item.properties["sg_content_hash_key"]] = {
+            "type": version["type"],
+            "id": version["id"],
+        }
+
+        # write to a temporary file first so that concurrent publishers never
+        # read a partially written index
+        index_path = self._get_hash_index_path()
+        tmp_path = "%s.%d.tmp" % (index_path, os.getpid())
+        try:
+            if not os.path.exists(os.path.dirname(index_path)):
+                os.makedirs(os.path.dirname(index_path))
+            with open(tmp_path, "w") as fp:
+                json.dump(hash_index, fp)
+            os.replace(tmp_path, index_path)
+        except (IOError, OSError) as e:
+            self.logger.warning("Unable to save the Version hash index: %s" % (e,))
+
+    def _load_hash_index(self):
+        """
+        Read the local index mapping content hashes to Versions.
+
+        :returns: A dict mapping each key returned by :meth:`_get_hash_index_key`
+            to a Version entity dict.
+        """
+        try:
+            with open(self._get_hash_index_path(), "r") as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def _get_hash_index_path(self):
+        """
+        The path of the local content hash index.
+        """
+        return os.path.join(self.parent.cache_location, "version_hash_index.json")
+
+    def _upload_in_thread(self, user, version_id, path, upload, resumable):
+        """
+        Upload a movie or a thumbnail from a worker thread.
+
+        :param user: The user to create the thread's connection with.
+        :param int version_id: The id of the Version to upload to.
+        :param str path: The movie or thumbnail to upload.
+        :param bool upload: True to upload a movie, False for a thumbnail.
+        :param bool resumable: True to upload the movie in resumable chunks.
+        """
+        sg = getattr(self._upload_connections, "sg", None)
+        if sg is None:
+            sg = self._upload_connections.sg = user.create_sg_connection()
+
+        if upload:
+            # progress can't be logged from a worker thread since the publisher
+            # log is a Qt widget
+            self._upload_movie(sg, version_id, path, resumable)
+        else:
+            sg.upload_thumbnail("Version", version_id, path)
+
+    def _upload_movie(self, sg, version_id, path, resumable, progress_callback=None):
+        """
+        Upload a movie to a Version.
+
+        :param sg: Shotgun API instance
+        :param int version_id: The id of the Version to upload to.
+        :param str path: The movie to upload.
+        :param bool resumable: True to upload the movie in resumable chunks.
+        :param progress_callback: Optional callable receiving the number of
+            bytes uploaded so far and the total number of bytes.
+        """
+        if not resumable:
+            sg.upload("Version", version_id, path, "sg_uploaded_movie")
+            return
+
+        upload = ResumableUpload(
+            sg, self._get_upload_state_folder(), progress_callback=progress_callback
+        )
+        upload.upload("Version", version_id, path, "sg_uploaded_movie")
+
+    def _get_upload_state_folder(self):
+        """
+        The folder the state of the resumable uploads is saved in.
+        """
+        return os.path.join(self.parent.cache_location, "resumable_uploads")
+
+    def _log_upload_progress(self, bytes_sent, total_bytes):
+        """
+        Log the progress of an upload, every 10 percent.
+
+        :param int bytes_sent: The number of bytes uploaded so far.
+        :param int total_bytes: The total number of bytes to upload.
+        """
+        percent = 100 * bytes_sent // total_bytes
+        previous_percent = 100 * (bytes_sent - UPLOAD_CHUNK_SIZE) // total_bytes
+        if bytes_sent == total_bytes or percent // 10 != previous_percent // 10:
+            self.logger.info("Uploaded %d%% (%d MB)" % (percent, bytes_sent // (1024 * 1024)))
+
+    def _get_upload_path(self, path):
+        """
+        On windows, ensure the path is utf-8 encoded to avoid issues with
+        the shotgun api.
+
+        :param str path: The path to upload.
+        """
+        if sgtk.util.is_windows():
+            return six.ensure_text(path)
+        return path
+    # --- end customization
+
+
+# --- Yeti - begin customization
+class ResumableUpload(object):
+    """
+    Upload of a file to the site cloud storage in parts, which can be resumed
+    after a failure.
+
+    Each part is retried with an exponential backoff. The upload state is
+    saved to disk after each part, keyed by the identity of the file, so that
+    uploading the same file again to the same entity continues where it
+    stopped. The entity is stored in the state, see :meth:`get_pending_entity`. Sites not using direct cloud storage
+    uploads, and files smaller than a part, fall back to a regular upload.
+
+    .. note:: This relies on the multipart upload methods of the Shotgun API
+        instance, which are the ones its own upload method uses.
+    """
+
+    def __init__(
+        self,
+        sg,
+        state_folder,
+        chunk_size=UPLOAD_CHUNK_SIZE,
+        max_retries=UPLOAD_MAX_RETRIES,
+        progress_callback=None,
+    ):
+        """
+        :param sg: Shotgun API instance
+        :param str state_folder: Folder the state of the uploads is saved in.
+        :param int chunk_size: Size in bytes of the uploaded parts.
+        :param int max_retries: Number of times a failed request is retried.
+        :param progress_callback: Optional callable receiving the number of
+            bytes uploaded so far and the total number of bytes.
+        """
+        self._sg = sg
+        self._state_folder = state_folder
+        self._chunk_size = chunk_size
+        self._max_retries = max_retries
+        self._progress_callback = progress_callback
+
+    def upload(self, entity_type, entity_id, path, field_name):
+        """
+        Upload a file and link it to an entity field.
+
+        :param str entity_type: The entity type to link the file to.
+        :param int entity_id: The id of the entity to link the file to.
+        :param str path: The file to upload.
+        :param str field_name: The field to link the file to.
+
+        :returns: The id of the created Attachment.
+        """
+        file_size = os.path.getsize(path)
+        if (
+            not self._sg.server_info.get("s3_direct_uploads_enabled", False)
+            or file_size <= self._chunk_size
+        ):
+            return self._sg.upload(entity_type, entity_id, path, field_name)
+
+        filename = os.path.basename(path)
+        state_path = self._get_state_path(path, field_name)
+        entity = {"type": entity_type, "id": entity_id}
+
+        state = self._load_state(state_path)
+        if (
+            state
+            and state["chunk_size"] == self._chunk_size
+            and state.get("entity") == entity
+        ):
+            logger.info(
+                "Resuming upload of %s from part %d." % (filename, len(state["etags"]) + 1)
+            )
+            try:
+                return self._upload_parts(entity, path, field_name, state_path, state)
+            except Exception as e:
+                # the multipart upload may have expired or been aborted on the
+                # server, never resume it again
+                logger.warning(
+                    "Unable to resume the upload of %s (%s), restarting it." % (filename, e)
+                )
+                try:
+                    os.remove(state_path)
+                except OSError:
+                    pass
+
+        self._remove_expired_states()
+        upload_info = self._retry(self._sg._get_attachment_upload_info, False, filename, True)
+        state = {
+            "entity": entity,
+            "chunk_size": self._chunk_size,
+            "upload_info": upload_info,
+            "etags": [],
+        }
+        self._save_state(state_path, state)
+        return self._upload_parts(entity, path, field_name, state_path, state)
+
+    def _upload_parts(self, entity, path, field_name, state_path, state):
+        """
+        Upload the parts of a file which are not uploaded yet, then link the file
+        to the entity field.
+
+        :param dict entity: The entity to link the file to.
+        :param str path: The file to upload.
+        :param str field_name: The field to link the file to.
+        :param str state_path: The file the state of the upload is saved in.
+        :param dict state: The state of the upload.
+
+        :returns: The id of the created Attachment.
+        """
+        filename = os.path.basename(path)
+        file_size = os.path.getsize(path)
+        # like the Shotgun API, upload files of unknown type as binary data
+        content_type = mimetypes.guess_type(path)[0] or "application/octet-stream"
+        upload_info = state["upload_info"]
+
+        with open(path, "rb") as fp:
+            bytes_sent = len(state["etags"]) * self._chunk_size
+            fp.seek(bytes_sent)
+            while True:
+                data = fp.read(self._chunk_size)
+                if not data:
+                    break
+
+                part_number = len(state["etags"]) + 1
+                etag = self._retry(
+                    self._upload_part, upload_info, filename, part_number, data, content_type
+                )
+                state["etags"].append(etag)
+                self._save_state(state_path, state)
+
+                bytes_sent += len(data)
+                if self._progress_callback:
+                    self._progress_callback(bytes_sent, file_size)
+
+        self._retry(self._sg._complete_multipart_upload, upload_info, filename, state["etags"])
+        attachment_id = self._link_file(
+            entity["type"], entity["id"], field_name, filename, upload_info
+        )
+
+        os.remove(state_path)
+        return attachment_id
+
+    def get_pending_entity(self, path, field_name):
+        """
+        Return the entity an interrupted upload of the file was uploading to.
+
+        :param str path: The file to upload.
+        :param str field_name: The field the file is linked to.
+
+        :returns: The entity dict, or None if there is no interrupted upload.
+        """
+        try:
+            state = self._load_state(self._get_state_path(path, field_name))
+        except OSError:
+            return None
+        return state.get("entity") if state else None
+
+    def _upload_part(self, upload_info, filename, part_number, data, content_type):
+        """
+        Upload a single part of the file.
+
+        :returns: The etag of the uploaded part.
+        """
+        # the part links are only valid for a limited time, get a new one for
+        # every attempt
+        part_url = self._sg._get_upload_part_link(upload_info, filename, part_number)
+        return self._sg._upload_data_to_storage(data, content_type, len(data), part_url)
+
+    def _link_file(self, entity_type, entity_id, field_name, filename, upload_info):
+        """
+        Link the uploaded file to the entity field.
+
+        :returns: The id of the created Attachment.
+        """
+        url = urllib.parse.urlunparse(
+            (
+                self._sg.config.scheme,
+                self._sg.config.server,
+                "/upload/api_link_file",
+                None,
+                None,
+                None,
+            )
+        )
+        params = {
+            "entity_type": entity_type,
+            "entity_id": entity_id,
+            "upload_link_info": upload_info["upload_info"],
+            "field_name": field_name,
+            "display_name": filename,
+        }
+        params.update(self._sg._auth_params())
+
+        result = self._retry(self._sg._send_form, url, params)
+        if not result.startswith("1"):
+            raise TankError("Could not link the uploaded file %s: %s" % (filename, result))
+
+        return int(result.split(":", 2)[1].split("\n", 1)[0])
+
+    def _retry(self, method, *args):
+        """
+        Call the given method, retrying with an exponential backoff when it fails.
+        """
+        for attempt in range(self._max_retries + 1):
+            try:
+                return method(*args)
+            except Exception as e:
+                if attempt == self._max_retries:
+                    raise
+                delay = UPLOAD_RETRY_DELAY * 2 ** attempt
+                logger.debug("Upload request failed (%s), retrying in %d seconds." % (e, delay))
+                time.sleep(delay)
+
+    def _get_state_path(self, path, field_name):
+        """
+        The path of the file storing the state of the upload. It only depends on
+        the site, the field and the identity of the file, and changes when the
+        file to upload is modified.
+        """
+        stat = os.stat(path)
+        key = "|".join(
+            str(part)
+            for part in (
+                self._sg.base_url,
+                field_name,
+                os.path.abspath(path),
+                stat.st_size,
+                stat.st_mtime,
+            )
+        )
+        return os.path.join(
+            self._state_folder, "%s.json" % hashlib.sha1(key.encode("utf-8")).hexdigest()
+        )
+
+    def _load_state(self, state_path):
+        """
+        Read the saved state of an upload.
+
+        :returns: The state dict, or None if there is no valid saved state.
+        """
+        try:
+            with open(state_path, "r") as fp:
+                return json.load(fp)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _remove_expired_states(self):
+        """
+        Remove the states of the uploads interrupted for too long, e.g. because
+        their file was modified since.
+        """
+        try:
+            entries = list(os.scandir(self._state_folder))
+        except OSError:
+            return
+
+        expiry_time = time.time() - UPLOAD_STATE_MAX_AGE * 24 * 3600
+        for entry in entries:
+            try:
+                if entry.stat().st_mtime < expiry_time:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def _save_state(self, state_path, state):
+        """
+        Save the state of an upload.
+        """
+        if not os.path.exists(self._state_folder):
+            os.makedirs(self._state_folder)
+
+        tmp_path = "%s.tmp" % (state_path,)
+        with open(tmp_path, "w") as fp:
+            json.dump(state, fp)
+        os.replace(tmp_path, state_path)
+
+
+def hash_file(path):
+    """
+    Compute the hash of the given file content.
+
+    The file is read in chunks so that memory use does not depend on its size.
+    Large files are memory mapped to avoid copying their content.
+
+    :param str path: The file to hash.
+
+    :returns: The hexadecimal digest of the content.
+    """
+    hasher = hashlib.blake2b()
+
+    with open(path, "rb") as fp:
+        file_size = os.fstat(fp.fileno()).st_size
+
+        if file_size > HASH_MMAP_THRESHOLD:
+            with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    for offset in range(0, file_size, HASH_CHUNK_SIZE):
+                        hasher.update(view[offset:offset + HASH_CHUNK_SIZE])
+                finally:
+                    view.release()
+        else:
+            buffer = bytearray(HASH_CHUNK_SIZE)
+            view = memoryview(buffer)
+            while True:
+                size = fp.readinto(buffer)
+                if not size:
+                    break
+                hasher.update(view[:size])
+
+    return hasher.hexdigest()
+# --- end customization
@@ -0,0 +1,351 @@
+# Copyright (c) 2024 Yeti Tools Software
+#
+# CONFIDENTIAL AND PROPRIETARY
+
+"""
+Hook that copies the work file to its snapshot location.
+
+The snapshot app checks that the snapshot path exists as soon as this hook returns,
+before recording the comment and thumbnail of the snapshot, so the snapshot is
+always stored before returning. When the app is flagged for background thinning, e.g.
+by the snapshot taken after a Quickdaily, the thinning of the older snapshots, which
+lists and removes files on network storage, runs on a background thread instead so
+the DCC isn't blocked by it. Pending thinnings of the same work file are coalesced.
+
+Snapshots are stored by content: each snapshot path is a hard link to a blob named
+after the hash of its content, in a hidden folder next to the snapshots, so that
+identical snapshots share their storage. As hard links share one inode, editing a
+snapshot in place changes all the snapshots with the same content: snapshots must
+only be restored, by copying them. After a new snapshot is stored, the older
+snapshots of the same work file are thinned out by a retention policy: all the
+snapshots of the last day are kept, then one per day, then one per week.
+"""
+
+import atexit
+import datetime
+import hashlib
+import os
+import shutil
+import threading
+
+import sgtk
+
+HookBaseClass = sgtk.get_hook_baseclass()
+
+# name of the attribute of the snapshot app enabling background thinning
+BACKGROUND_THINNING_ATTRIBUTE = "background_thinning"
+
+# number of seconds to wait for the pending thinnings when the process exits
+EXIT_TIMEOUT = 300
+
+# name of the folder holding the snapshot blobs, in the snapshot folder
+BLOB_FOLDER_NAME = ".snapshot_blobs"
+
+# size of the chunks read when copying and hashing a snapshot
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# format of the timestamp field of the snapshot templates, as written by the app
+TIMESTAMP_FORMAT = "%Y-%m-%d_%H-%M-%S"
+
+# fields of the snapshot templates which differ between the snapshots of a work file
+SNAPSHOT_FIELDS = ("timestamp", "increment")
+
+# number of days all the snapshots are kept, then the number of days one snapshot
+# per day is kept, after which one snapshot per week is kept
+SNAPSHOT_KEEP_ALL_DAYS = float(os.environ.get("YETI_SNAPSHOT_KEEP_ALL_DAYS", 1))
+SNAPSHOT_KEEP_DAILY_DAYS = float(os.environ.get("YETI_SNAPSHOT_KEEP_DAILY_DAYS", 30))
+
+
+class CopyFile(HookBaseClass):
+    def execute(self, source_path, target_path, **kwargs):
+        """
+        Copy the work file to the snapshot path.
+
+        The hook is also used to restore a snapshot, in which case the target is the
+        work file and the file is simply copied.
+
+        :param str source_path: The path of the work file.
+        :param str target_path: The snapshot path.
+        """
+        snapshot_template = self.parent.get_template("template_snapshot")
+        if not snapshot_template.validate(target_path):
+            _ensure_folder(os.path.dirname(target_path))
+            shutil.copy(source_path, target_path)
+            return
+
+        snapshot_store = SnapshotStore(snapshot_template, self.logger)
+        snapshot_store.add(source_path, target_path)
+
+        if getattr(self.parent, BACKGROUND_THINNING_ATTRIBUTE, False):
+            _get_snapshot_thinner().push(source_path, target_path, snapshot_store)
+        else:
+            snapshot_store.thin(target_path)
+
+
+class SnapshotStore(object):
+    """
+    Content addressed storage of the snapshots of a snapshot template.
+    """
+
+    def __init__(self, snapshot_template, logger):
+        """
+        :param snapshot_template: The template of the snapshot paths.
+        :param logger: Logger to report the progress to.
+        """
+        self._template = snapshot_template
+        self.logger = logger
+
+    def add(self, source_path, target_path):
+        """
+        Store a file as a snapshot. The file is copied next to the snapshot path
+        and hashed in the same pass, so that it is only read once. The snapshot
+        path is then linked to the blob of the same content if there is one, and
+        the copy dropped. Otherwise the copy becomes the snapshot, which is then
+        linked as the blob of its content.
+
+        On storage without hard links, the file is simply copied.
+
+        :param str source_path: The file to store.
+        :param str target_path: The snapshot path.
+        """
+        snapshot_folder = os.path.dirname(target_path)
+        blob_folder = os.path.join(snapshot_folder, BLOB_FOLDER_NAME)
+        _ensure_folder(blob_folder)
+
+        tmp_path = "%s.%d.tmp" % (target_path, os.getpid())
+        try:
+            content_hash = _copy_and_hash_file(source_path, tmp_path)
+            blob_path = os.path.join(
+                blob_folder, content_hash + os.path.splitext(target_path)[1]
+            )
+            try:
+                os.link(blob_path, target_path)
+                self.logger.debug(
+                    "Snapshot %s has the content of %s" % (target_path, blob_path)
+                )
+                return
+            except OSError:
+                # no blob of this content, no hard links, or the blob was removed
+                # in the meantime
+                pass
+            os.replace(tmp_path, target_path)
+        finally:
+            _remove(tmp_path)
+
+        try:
+            os.link(target_path, blob_path)
+        except OSError:
+            # no hard links, or the blob was stored by another process
+            pass
+
+    def thin(self, target_path):
+        """
+        Remove the older snapshots of the work file of a snapshot path which are not
+        kept by the retention policy.
+
+        :param str target_path: The latest snapshot path.
+        """
+        fields = self._template.get_fields(target_path)
+        work_fields = _get_work_fields(fields)
+        snapshot_folder = os.path.dirname(target_path)
+
+        snapshots = []
+        for file_name in os.listdir(snapshot_folder):
+            path = os.path.join(snapshot_folder, file_name)
+            if not self._template.validate(path):
+                continue
+            path_fields = self._template.get_fields(path)
+            if _get_work_fields(path_fields) != work_fields:
+                continue
+            try:
+                timestamp = datetime.datetime.strptime(
+                    path_fields["timestamp"], TIMESTAMP_FORMAT
+                )
+            except (KeyError, ValueError):
+                # never remove snapshots we don't understand
+                continue
+            snapshots.append((timestamp, path))
+
+        now = datetime.datetime.now()
+        kept_periods = set()
+        removed_paths = []
+        # the latest snapshot of each day or week is kept
+        for timestamp, path in sorted(snapshots, reverse=True):
+            age = now - timestamp
+            if age <= datetime.timedelta(days=SNAPSHOT_KEEP_ALL_DAYS):
+                continue
+            elif age <= datetime.timedelta(days=SNAPSHOT_KEEP_DAILY_DAYS):
+                period = ("day", timestamp.date())
+            else:
+                period = ("week",) + tuple(timestamp.isocalendar()[:2])
+
+            if period in kept_periods:
+                removed_paths.append(path)
+            else:
+                kept_periods.add(period)
+
+        for path in removed_paths:
+            self.logger.debug("Removing snapshot %s" % (path,))
+            _remove(path)
+
+        if removed_paths:
+            self._remove_unused_blobs(os.path.join(snapshot_folder, BLOB_FOLDER_NAME))
+
+    def _remove_unused_blobs(self, blob_folder):
+        """
+        Remove the blobs which are not linked to any snapshot anymore.
+        """
+        try:
+            file_names = os.listdir(blob_folder)
+        except OSError:
+            return
+
+        for file_name in file_names:
+            path = os.path.join(blob_folder, file_name)
+            try:
+                if os.stat(path).st_nlink == 1:
+                    os.remove(path)
+            except OSError:
+                pass
+
+
+class SnapshotThinner(object):
+    """
+    Background thread thinning out the snapshots of work files.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+
+        # pending jobs per work file, in the order they were queued
+        self._jobs = {}
+        self._order = []
+
+        # whether a job is being run
+        self._busy = False
+
+        self._thread = None
+
+    def push(self, source_path, target_path, snapshot_store):
+        """
+        Queue the thinning of the snapshots of a work file.
+
+        :param str source_path: The path of the work file.
+        :param str target_path: The latest snapshot path of the work file.
+        :param snapshot_store: The store of the snapshot.
+        :type snapshot_store: :class:`SnapshotStore`
+        """
+        key = os.path.normcase(os.path.normpath(source_path))
+
+        with self._condition:
+            if key not in self._jobs:
+                self._order.append(key)
+            else:
+                # the snapshots of the same work file are still waiting to be
+                # thinned out, only thin them once from the latest snapshot
+                snapshot_store.logger.debug(
+                    "Coalescing the thinning of snapshot %s" % (target_path,)
+                )
+            self._jobs[key] = (target_path, snapshot_store)
+
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="SnapshotThinner", daemon=True
+                )
+                self._thread.start()
+            self._condition.notify_all()
+
+    def wait(self, timeout=None):
+        """
+        Wait for the pending thinnings to be done.
+
+        :param float timeout: Maximum number of seconds to wait.
+
+        :returns: True if all the thinnings are done.
+        """
+        with self._condition:
+            return self._condition.wait_for(
+                lambda: not self._order and not self._busy, timeout
+            )
+
+    def _run(self):
+        """
+        Run the pending jobs, forever.
+        """
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._order)
+                key = self._order.pop(0)
+                target_path, snapshot_store = self._jobs.pop(key)
+                self._busy = True
+
+            try:
+                snapshot_store.thin(target_path)
+            except Exception:
+                snapshot_store.logger.exception("Unable to thin out the snapshots")
+            finally:
+                with self._condition:
+                    self._busy = False
+                    self._condition.notify_all()
+
+
+# the snapshot thinner of the process, created on first use
+_snapshot_thinner = None
+_snapshot_thinner_lock = threading.Lock()
+
+
+def _get_snapshot_thinner():
+    """
+    Return the snapshot thinner of the process, waiting for its pending jobs when
+    the process exits.
+    """
+    global _snapshot_thinner
+    with _snapshot_thinner_lock:
+        if _snapshot_thinner is None:
+            _snapshot_thinner = SnapshotThinner()
+            atexit.register(_snapshot_thinner.wait, EXIT_TIMEOUT)
+        return _snapshot_thinner
+
+
+def _copy_and_hash_file(source_path, target_path):
+    """
+    Copy a file with its permissions, hashing its content while it is copied.
+
+    :returns: The hexadecimal hash of the content of the file.
+    """
+    hasher = hashlib.blake2b(digest_size=32)
+    with open(source_path, "rb") as source_fp, open(target_path, "wb") as target_fp:
+        for chunk in iter(lambda: source_fp.read(HASH_CHUNK_SIZE), b""):
+            hasher.update(chunk)
+            target_fp.write(chunk)
+    shutil.copymode(source_path, target_path)
+    return hasher.hexdigest()
+
+
+def _get_work_fields(fields):
+    """
+    Return the fields of a snapshot path identifying its work file.
+    """
+    return {key: value for key, value in fields.items() if key not in SNAPSHOT_FIELDS}
+
+
+def _ensure_folder(folder):
+    """
+    Create a folder with open permissions if it doesn't exist.
+    """
+    if not os.path.isdir(folder):
+        old_umask = os.umask(0)
+        try:
+            os.makedirs(folder, 0o777, exist_ok=True)
+        finally:
+            os.umask(old_umask)
+
+
+def _remove(path):
+    """
+    Remove a file, ignoring errors.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass